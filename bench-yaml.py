@@ -0,0 +1,78 @@
+"""
+Benchmarks loading and dumping a realistic irt_peptides.logs.yaml
+with the pure-python yaml loader/dumper against the libyaml C ones
+that datafile uses when available, and against the json and msgpack
+cache formats.
+
+Usage: python bench-yaml.py [n_log]
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+from massspechistory import datafile
+from massspechistory import yaml
+
+
+def make_irt_logs(n_log):
+    logs = []
+    timestamp = 1420070400
+    for i in range(n_log):
+        timestamp += 3600*random.randint(6, 48)
+        peptides = {}
+        for c in 'abcdefghijk':
+            peptides['pep_' + c] = {
+                'RT': random.uniform(10, 60),
+                'Height': random.uniform(1e6, 1e9),
+                'Area': random.uniform(1e7, 1e10),
+                'crt': random.uniform(0, 100),
+                'System Suitability': 'Passed: R T O B D S W N C',
+            }
+        logs.append({
+            'fname': 'instrument_data/hela_%012d_iRT.txt' % i,
+            'timestamp': timestamp,
+            'iso_date_str': '2015-01-01T00:00:00+00:00',
+            'fingerprint': [123456, 1420070400.0, '%040x' % i],
+            'peptides': peptides,
+            'irt_summ': dict((f, random.randint(0, 3)) for f in 'RTOBDSWNC'),
+        })
+    return logs
+
+
+def bench(logs, cache_yaml, loader, dumper, file_format='yaml'):
+    datafile.YamlLoader, datafile.YamlDumper = loader, dumper
+    start = time.time()
+    datafile.write_cache(logs, cache_yaml, file_format)
+    dump_time = time.time() - start
+    start = time.time()
+    datafile.load_cache(cache_yaml)
+    load_time = time.time() - start
+    return dump_time, load_time
+
+
+if __name__ == "__main__":
+    n_log = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    logs = make_irt_logs(n_log)
+    cache_yaml = os.path.join(tempfile.mkdtemp(), 'irt_peptides.logs.yaml')
+
+    variants = [('python', yaml.SafeLoader, yaml.SafeDumper, 'yaml')]
+    if datafile.libyaml is not None:
+        variants.append(
+            ('libyaml', datafile.libyaml.CSafeLoader,
+             datafile.libyaml.CSafeDumper, 'yaml'))
+    else:
+        print("libyaml not available, only timing the python yaml")
+    variants.append(('json', None, None, 'json'))
+    if datafile.msgpack is not None:
+        variants.append(('msgpack', None, None, 'msgpack'))
+
+    print("%d logs" % n_log)
+    for name, loader, dumper, file_format in variants:
+        if loader is None:
+            loader, dumper = datafile.YamlLoader, datafile.YamlDumper
+        dump_time, load_time = bench(
+            logs, cache_yaml, loader, dumper, file_format)
+        print("%-8s dump %6.2fs  load %6.2fs" % (name, dump_time, load_time))
@@ -11,10 +11,20 @@ and calculates the fraction of common peptides.
 import os
 import glob
 import calendar
+import datetime
+import hashlib
+import json
+import math
+import array
+import struct
+import base64
+import re
 import logging
+import multiprocessing
 import pytz
 
 import datafile
+import logcache
 
 
 logger = logging.getLogger('chart')
@@ -41,23 +51,24 @@ def parse_morpheus_psm(fname):
         celltype = 'Hela'
     elif 'ecoli' in fname:
         celltype = 'Ecoli'
-    values = []
     key = 'Precursor Mass Error (ppm)'
-    for entry in datafile.read_csv(fname):
-        if entry['Target?'].lower() != "true":
+    stats = datafile.RunningAvgStd()
+    columns = ['Target?', 'Q-Value (%)', key]
+    for is_target, q_value, value in datafile.iter_csv_columns(fname, columns):
+        if is_target.lower() != "true":
             continue
-        if float(entry['Q-Value (%)']) > 1:
+        if float(q_value) > 1:
             continue
-        value = float(entry[key])
+        value = float(value)
         if abs(value) > 20:
             continue
-        values.append(value)
-    if len(values) == 0:
+        stats.add(value)
+    if stats.n == 0:
         return {}
     else:
         average_param = celltype + ' ' + key
         upper_param = celltype + ' ' + key + ' Upper'
-        avg, std = datafile.get_avg_std(values)
+        avg, std = stats.get_avg_std()
         result = {
             average_param: avg,
             upper_param: avg + std
@@ -134,42 +145,137 @@ def parse_irt_log(fname):
 #    print log.keys()
     return log
 
-def parse_logs(fnames, parse_fn, cache_yaml):
-    if os.path.isfile(cache_yaml):
-        logs = datafile.load_yaml(cache_yaml)
-    else:
-        logs = []
-    logs = filter(lambda log: 'fname' in log, logs)
-    processed_fnames = [log['fname'] for log in logs]
-#    print processed_fnames
+def load_logs(cache_yaml, backend=None):
+    """
+    Returns the logs cached for `cache_yaml` by parse_logs, using
+    the logcache `backend` (defaults to logcache.default_backend).
+    """
+    logs = logcache.get_log_cache(cache_yaml, backend).load()
+    return filter(lambda log: 'fname' in log, logs)
+
+
+def get_fingerprint(fname, prev_fingerprint=None):
+    """
+    Returns the [size, mtime, content-hash] fingerprint of fname, and
+    whether it differs from prev_fingerprint. The content hash is only
+    computed if the size or mtime has changed.
+    """
+    stat = os.stat(fname)
+    size, mtime = stat.st_size, stat.st_mtime
+    if prev_fingerprint is not None:
+        prev_size, prev_mtime, prev_hash = prev_fingerprint
+        if size == prev_size and mtime == prev_mtime:
+            return prev_fingerprint, False
+        file_hash = datafile.get_file_hash(fname)
+        return [size, mtime, file_hash], file_hash != prev_hash
+    return [size, mtime, datafile.get_file_hash(fname)], True
+
+
+def parse_log(fname, parse_fn):
+    print fname
+    date = datafile.get_date_from_fname(fname)
+    print date
+    if date is None:
+        return None
+
+    try:
+        log = {
+          'fname': fname,
+          'timestamp': calendar.timegm(date.timetuple()),
+          'iso_date_str': date.isoformat(),
+          'fingerprint': get_fingerprint(fname)[0],
+        }
+        parsed_log = parse_fn(fname)
+        log.update(parsed_log)
+        return log
+    except KeyboardInterrupt:
+        raise
+    except Exception as E:
+        logger.debug("Error parsing " + fname + ": " + str(E))
+        return None
+
+
+def parse_log_job(job):
+    fname, parse_fn = job
+    return parse_log(fname, parse_fn)
+
+
+def parse_log_jobs(jobs, workers=1):
+    """
+    Returns the parsed logs of (fname, parse_fn) jobs, in the same
+    order. With workers > 1, the jobs are parsed in a pool of
+    processes; parse_fn must then be a module-level function. Files
+    that fail to parse give None, and don't stop the other jobs.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        return [parse_log_job(job) for job in jobs]
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    try:
+        results = pool.map(parse_log_job, jobs, chunksize=1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
 
+def parse_logs(fnames, parse_fn, cache_yaml, backend=None, workers=1):
+    """
+    Returns the logs of fnames, sorted by timestamp. Logs are cached
+    with their file fingerprint, so only new files, and files that
+    have changed since they were parsed, are (re-)parsed, using
+    `workers` processes.
+    """
+    cache = logcache.get_log_cache(cache_yaml, backend)
+    logs = filter(lambda log: 'fname' in log, cache.load())
+    log_by_fname = dict((log['fname'], log) for log in logs)
+    new_logs = []
+
+    parse_fnames = []
     for fname in fnames:
-        if fname in processed_fnames:
-            print "processed",fname
-            continue
-        print fname
-        date = datafile.get_date_from_fname(fname)
-        print date
-        if date is None:
-            continue
+        cached_log = log_by_fname.get(fname)
 
-        try:
-            log = {
-              'fname': fname,
-              'timestamp': calendar.timegm(date.timetuple()),
-              'iso_date_str': date.isoformat(),
-            }
-            parsed_log = parse_fn(fname)
-            log.update(parsed_log)
-            logs.append(log)
-        except KeyboardInterrupt:
-            raise
-        except Exception as E:
-            logger.debug("Error parsing " + fname + ": " + str(E))
+        if cached_log is not None:
+            if 'fingerprint' not in cached_log:
+                # logs cached before fingerprints: trust the parse,
+                # but record size and mtime to detect future changes
+                stat = os.stat(fname)
+                cached_log['fingerprint'] = [stat.st_size, stat.st_mtime, None]
+                new_logs.append(cached_log)
+                continue
+            fingerprint, is_changed = get_fingerprint(
+                fname, cached_log['fingerprint'])
+            if not is_changed:
+                if fingerprint != cached_log['fingerprint']:
+                    # touched but identical content
+                    cached_log['fingerprint'] = fingerprint
+                    new_logs.append(cached_log)
+                continue
+            logger.debug("Re-parsing changed " + fname)
+
+        parse_fnames.append(fname)
+
+    parsed_logs = parse_log_jobs(
+        [(fname, parse_fn) for fname in parse_fnames], workers)
+
+    for fname, log in zip(parse_fnames, parsed_logs):
+        if log is None:
             continue
+        cached_log = log_by_fname.get(fname)
+        if cached_log is not None:
+            # replace in place to keep the same entry in logs
+            cached_log.clear()
+            cached_log.update(log)
+            log = cached_log
+        else:
+            logs.append(log)
+            log_by_fname[fname] = log
+        new_logs.append(log)
 
     logs.sort(key=lambda l:l['timestamp'])
-    datafile.write_yaml(logs, cache_yaml)
+    cache.write(logs, new_logs)
 
     return logs
 
@@ -181,32 +287,477 @@ def get_param(log, params):
     return result
 
 
+class LogColumns(object):
+    """
+    Logs flattened once into columns for charting: the timestamps,
+    and for every path of keys to a number in the logs, e.g.
+    ('peptides', 'pep_a', 'RT'), an array of floats with NaN where
+    a log has no value.
+    """
+
+    def __init__(self, logs):
+        logs = [log for log in logs if 'timestamp' in log]
+        n = len(logs)
+        self.timestamps = [log['timestamp'] for log in logs]
+        self.columns = {}
+        for i, log in enumerate(logs):
+            for keys, value in iter_numeric_params(log):
+                if keys not in self.columns:
+                    self.columns[keys] = array.array('d', [NAN]) * n
+                self.columns[keys][i] = value
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def get_column(self, keys):
+        return self.columns.get(tuple(keys))
+
+
+NAN = float('nan')
+
+
+def iter_numeric_params(log, keys=()):
+    for key, val in log.items():
+        if isinstance(val, dict):
+            for item in iter_numeric_params(val, keys + (key,)):
+                yield item
+        elif isinstance(val, (int, long, float)) \
+                and not isinstance(val, bool) and key != 'timestamp':
+            yield keys + (key,), val
+
+
 def make_chart(logs, params, title, description=''):
+    """
+    Returns the chart of the params, a list of [name, keys] where keys
+    is the path to a value in a log. logs is either a list of logs, or
+    LogColumns, which should be built once to draw several charts.
+    """
+    if not isinstance(logs, LogColumns):
+        logs = LogColumns(logs)
     result = {
         "title": title,
         "description": description,
         "chart_data": [],
     }
+    xs = [t*1000 for t in logs.timestamps]  # -> milliseconds for js
     for param in params:
         name, keys = param
-        chart = { "key": name, "values": [] }
-        for log in logs:
-            try:
-                try:
-                    y = get_param(log, keys)
-                except:
-                    y = None
-                x = log['timestamp']*1000  # -> milliseconds for js 
-                chart['values'].append([x, y])
-            except:
-                pass
-        values = [pair[1] for pair in chart['values']]
-        values = filter(lambda v: v is not None, values)
-        if len(values) > 0:
-            result['chart_data'].append(chart)
+        column = logs.get_column(keys)
+        if column is None:
+            continue
+        values = [[x, None if y != y else y] for x, y in zip(xs, column)]
+        result['chart_data'].append({ "key": name, "values": values })
     return result
 
 
+def encode_array(values, type_code):
+    """
+    Returns values packed as a little-endian typed array in base64,
+    for the javascript decoder in template.web/compact.js.
+    """
+    data = struct.pack('<%d%s' % (len(values), type_code), *values)
+    return base64.b64encode(data).decode('ascii')
+
+
+def encode_charts(charts):
+    """
+    Returns the charts of make_chart in a compact encoding. All series
+    share one time axis, stored as the deltas between the sorted,
+    distinct timestamps in a Float64 array. Each series is a Float32
+    array over the axis, with NaN where the series has no value.
+    Decode with decode_charts in template.web/compact.js.
+    """
+    xs = set()
+    for chart in charts:
+        for series in chart['chart_data']:
+            xs.update(x for x, y in series['values'])
+    xs = sorted(xs)
+    i_x_by_x = dict((x, i) for i, x in enumerate(xs))
+    deltas = [x - prev_x for x, prev_x in zip(xs, [0] + xs[:-1])]
+
+    compact_charts = []
+    for chart in charts:
+        compact_chart_data = []
+        for series in chart['chart_data']:
+            ys = [NAN] * len(xs)
+            for x, y in series['values']:
+                if y is not None:
+                    ys[i_x_by_x[x]] = y
+            compact_chart_data.append({
+                'key': series['key'],
+                'y': encode_array(ys, 'f'),
+            })
+        compact_charts.append({
+            'title': chart['title'],
+            'description': chart['description'],
+            'chart_data': compact_chart_data,
+        })
+
+    return {
+        'encoding': 'compact',
+        'x': encode_array(deltas, 'd'),
+        'charts': compact_charts,
+    }
+
+
+def downsample_lttb(values, n_point):
+    """
+    Returns at most n_point of the [x, y] values, chosen by the
+    Largest-Triangle-Three-Buckets algorithm to preserve the visual
+    shape of the series. Points with no y are dropped.
+    """
+    values = [v for v in values if v[1] is not None]
+    n = len(values)
+    if n <= n_point or n_point < 3:
+        return values
+
+    sampled = [values[0]]
+    bucket_size = (n - 2) / float(n_point - 2)
+    i_a = 0
+    for i_bucket in range(n_point - 2):
+        start = int(i_bucket*bucket_size) + 1
+        end = int((i_bucket + 1)*bucket_size) + 1
+        next_end = min(int((i_bucket + 2)*bucket_size) + 1, n)
+        next_bucket = values[end:next_end]
+        avg_x = sum(v[0] for v in next_bucket) / float(len(next_bucket))
+        avg_y = sum(v[1] for v in next_bucket) / float(len(next_bucket))
+
+        ax, ay = values[i_a]
+        max_area = -1
+        for i in range(start, end):
+            x, y = values[i]
+            area = abs((ax - avg_x)*(y - ay) - (ax - x)*(avg_y - ay))
+            if area > max_area:
+                max_area = area
+                i_max = i
+        sampled.append(values[i_max])
+        i_a = i_max
+
+    sampled.append(values[-1])
+    return sampled
+
+
+def downsample_chart(chart, max_point):
+    """
+    Returns a copy of chart with the series downsampled by LTTB so that
+    the chart has about max_point points, or chart itself if it
+    already fits.
+    """
+    n_series = max(1, len(chart['chart_data']))
+    n_point = max(3, max_point // n_series)
+    if all(len(s['values']) <= n_point for s in chart['chart_data']):
+        return chart
+    result = dict(chart)
+    result['chart_data'] = []
+    for series in chart['chart_data']:
+        result['chart_data'].append({
+            'key': series['key'],
+            'values': downsample_lttb(series['values'], n_point),
+        })
+    return result
+
+
+def get_chart_id(chart):
+    return re.sub(r'[^a-z0-9]+', '_', chart['title'].lower()).strip('_')
+
+
+def write_chart_payload(
+        chart, website_dir, is_compact=False, max_point=None,
+        rollup_charts=None):
+    """
+    Writes chart to charts/<chart_id>.jsonp, which calls
+    load_chart({id: chart_id, charts: [chart]}), and returns its
+    entry for the manifest of write_manifest.
+
+    If max_point is given, and the chart has more points, the chart
+    is downsampled for the overview, and the full-resolution chart is
+    written to charts/<chart_id>.full.jsonp, given as full_url.
+
+    rollup_charts, the charts of make_rollup_charts, are written to
+    charts/<chart_id>.<period>.jsonp, given by period in rollup_urls,
+    so that long histories can be shown as daily, weekly or monthly
+    means.
+    """
+    charts_dir = os.path.join(website_dir, 'charts')
+    if not os.path.isdir(charts_dir):
+        os.makedirs(charts_dir)
+
+    chart_id = get_chart_id(chart)
+
+    def write_payload(chart, url):
+        payload = [chart]
+        if is_compact:
+            payload = encode_charts(payload)
+        datafile.write_jsonp(
+            {'id': chart_id, 'charts': payload},
+            os.path.join(website_dir, url),
+            'load_chart')
+
+    entry = {
+        'id': chart_id,
+        'title': chart['title'],
+        'description': chart['description'],
+        'url': 'charts/%s.jsonp' % chart_id,
+    }
+    overview_chart = chart
+    if max_point:
+        overview_chart = downsample_chart(chart, max_point)
+    if overview_chart is not chart:
+        entry['full_url'] = 'charts/%s.full.jsonp' % chart_id
+        write_payload(chart, entry['full_url'])
+    write_payload(overview_chart, entry['url'])
+    if rollup_charts:
+        entry['rollup_urls'] = {}
+        for period in ROLLUP_PERIODS:
+            url = 'charts/%s.%s.jsonp' % (chart_id, period)
+            entry['rollup_urls'][period] = url
+            write_payload(rollup_charts[period], url)
+    return entry
+
+
+def write_manifest(manifest, website_dir):
+    datafile.write_jsonp(
+        manifest,
+        os.path.join(website_dir, 'load_manifest.jsonp'),
+        'load_manifest')
+
+
+def write_chart_payloads(
+        charts, website_dir, is_compact=False, max_point=None):
+    """
+    Writes every chart to its own payload file with write_chart_payload,
+    and load_manifest.jsonp with the ids, titles, descriptions and urls
+    of the charts, so that the web app only loads the charts that are
+    scrolled into view.
+    """
+    manifest = []
+    for chart in charts:
+        manifest.append(
+            write_chart_payload(chart, website_dir, is_compact, max_point))
+    write_manifest(manifest, website_dir)
+
+
+# bumped when the charts drawn from the same logs and definitions
+# change, e.g. by a new payload format, to redraw every chart
+chart_payload_version = 2
+
+
+class ChartPayloads(object):
+    """
+    Writes the chart payloads of website_dir in groups of charts that
+    are drawn from the same logs. A group is only redrawn if the
+    fnames and fingerprints of its logs, its chart definitions, the
+    payload options or chart_payload_version have changed since the
+    last run, as recorded in charts.deps.json.
+    """
+
+    def __init__(self, website_dir, is_compact=False, max_point=None):
+        self.website_dir = website_dir
+        self.is_compact = is_compact
+        self.max_point = max_point
+        self.deps_json = os.path.join(website_dir, 'charts.deps.json')
+        if os.path.isfile(self.deps_json):
+            self.deps = datafile.load_json(self.deps_json)
+        else:
+            self.deps = {}
+        self.groups = []
+        self.signatures = {}
+        self.is_deps_changed = False
+
+    def get_signature(self, logs, definitions):
+        key = [
+            chart_payload_version,
+            definitions,
+            self.is_compact,
+            self.max_point,
+            [[log.get('fname'), log.get('fingerprint')] for log in logs],
+        ]
+        return hashlib.sha1(
+            json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def is_changed(self, group, logs, definitions):
+        """
+        Returns True if the charts of group have to be redrawn from
+        logs with write_charts, which must then be called. definitions
+        is whatever the charts are drawn from besides the logs, e.g.
+        the params and titles passed to make_chart, as json.
+        """
+        self.groups.append(group)
+        signature = self.get_signature(logs, definitions)
+        self.signatures[group] = signature
+        dep = self.deps.get(group)
+        if dep is None or dep['signature'] != signature:
+            return True
+        for entry in dep['manifest']:
+            urls = [entry[key] for key in ['url', 'full_url'] if key in entry]
+            urls.extend(entry.get('rollup_urls', {}).values())
+            for url in urls:
+                if not os.path.isfile(os.path.join(self.website_dir, url)):
+                    return True
+        return False
+
+    def write_charts(self, group, charts, rollup_charts=None):
+        """
+        Writes the payloads of charts, and of rollup_charts, a list of
+        the make_rollup_charts of each chart, if given.
+        """
+        if rollup_charts is None:
+            rollup_charts = [None] * len(charts)
+        manifest = []
+        for chart, chart_rollups in zip(charts, rollup_charts):
+            manifest.append(write_chart_payload(
+                chart, self.website_dir, self.is_compact, self.max_point,
+                chart_rollups))
+        self.deps[group] = {
+            'signature': self.signatures[group],
+            'manifest': manifest,
+        }
+        self.is_deps_changed = True
+
+    def write_manifest(self):
+        manifest = []
+        for group in self.groups:
+            manifest.extend(self.deps[group]['manifest'])
+        write_manifest(manifest, self.website_dir)
+        if self.is_deps_changed:
+            datafile.write_json(self.deps, self.deps_json)
+
+
+ROLLUP_PERIODS = ['day', 'week', 'month']
+
+# the periods of the rollups start at local midnight in the region of
+# the lab, as for the run dates in datafile.get_date_from_fname
+rollup_region = 'Australia/Melbourne'
+
+# bumped when the buckets of the rollups change, to rebuild old caches
+rollup_version = 2
+
+
+def get_period_start(timestamp, period, region=rollup_region):
+    """
+    Returns the timestamp of the local midnight in region that starts
+    the day, week (from Monday) or month that contains timestamp.
+    """
+    tz = datafile.get_timezone(region)
+    utc_date = pytz.utc.localize(datetime.datetime.utcfromtimestamp(timestamp))
+    date = utc_date.astimezone(tz).date()
+    if period == 'week':
+        date -= datetime.timedelta(days=date.weekday())
+    elif period == 'month':
+        date = date.replace(day=1)
+    start = tz.localize(datetime.datetime(date.year, date.month, date.day))
+    return calendar.timegm(start.astimezone(pytz.utc).timetuple())
+
+
+def get_log_hash(log):
+    log = dict((k, v) for k, v in log.items() if k != 'fingerprint')
+    return hashlib.sha1(
+        json.dumps(log, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def add_log_to_rollups(rollups, log):
+    starts = dict(
+        (period, str(get_period_start(log['timestamp'], period)))
+        for period in ROLLUP_PERIODS)
+    for keys, value in iter_numeric_params(log):
+        param = '\t'.join(keys)
+        for period in ROLLUP_PERIODS:
+            buckets = rollups[period].setdefault(param, {})
+            start = starts[period]
+            if start not in buckets:
+                buckets[start] = [0, 0.0, 0.0, value, value]
+            bucket = buckets[start]
+            bucket[0] += 1
+            bucket[1] += value
+            bucket[2] += value*value
+            bucket[3] = min(bucket[3], value)
+            bucket[4] = max(bucket[4], value)
+
+
+def update_rollups(logs, rollups_json):
+    """
+    Returns the daily, weekly and monthly rollups of every numeric
+    param of the logs, as {period: {param: {start: bucket}}}, where
+    param is the tab-joined path of keys, start is the timestamp of
+    the period, and bucket is [count, sum, sum_sq, min, max].
+
+    The rollups are kept in rollups_json with a hash of every log
+    added, so only new logs are added. If a log has been removed or
+    re-parsed with different values, the rollups are rebuilt.
+    """
+    logs = [log for log in logs if 'timestamp' in log]
+    cache = datafile.load_json(rollups_json) \
+        if os.path.isfile(rollups_json) else None
+
+    log_hashes = dict((log['fname'], get_log_hash(log)) for log in logs)
+    if cache is None or cache.get('version') != rollup_version or any(
+            log_hashes.get(fname) != log_hash
+            for fname, log_hash in cache['log_hashes'].items()):
+        cache = {
+            'version': rollup_version,
+            'log_hashes': {},
+            'rollups': dict((period, {}) for period in ROLLUP_PERIODS),
+        }
+
+    new_logs = [log for log in logs if log['fname'] not in cache['log_hashes']]
+    if new_logs or not os.path.isfile(rollups_json):
+        for log in new_logs:
+            add_log_to_rollups(cache['rollups'], log)
+            cache['log_hashes'][log['fname']] = log_hashes[log['fname']]
+        datafile.write_json(cache, rollups_json)
+
+    return cache['rollups']
+
+
+def get_bucket_stats(bucket):
+    count, value_sum, value_sum_sq, min_value, max_value = bucket
+    mean = value_sum / float(count)
+    std = math.sqrt(max(0.0, value_sum_sq / float(count) - mean*mean))
+    return {
+        'mean': mean,
+        'min': min_value,
+        'max': max_value,
+        'count': count,
+        'std': std,
+    }
+
+
+def make_rollup_chart(rollups, period, params, title, description=''):
+    """
+    Returns a chart like make_chart, of the mean of each param over the
+    periods of the rollups. Each series also has 'stats', the
+    mean/min/max/count/std of every point.
+    """
+    result = {
+        "title": title,
+        "description": description,
+        "period": period,
+        "chart_data": [],
+    }
+    for name, keys in params:
+        buckets = rollups[period].get('\t'.join(keys))
+        if not buckets:
+            continue
+        values = []
+        stats = []
+        for start in sorted(buckets, key=int):
+            bucket_stats = get_bucket_stats(buckets[start])
+            values.append([int(start)*1000, bucket_stats['mean']])
+            stats.append(bucket_stats)
+        result['chart_data'].append({
+            "key": name, "values": values, "stats": stats })
+    return result
+
+
+def make_rollup_charts(rollups, params, title, description=''):
+    """
+    Returns the rollup charts of make_rollup_chart by period.
+    """
+    return dict(
+        (period, make_rollup_chart(rollups, period, params, title, description))
+        for period in ROLLUP_PERIODS)
+
+
 def make_pep_id_params(pep_ids, param):
     pep_id_params = []
     for pep_id in sorted(pep_ids):
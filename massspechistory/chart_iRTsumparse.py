@@ -181,7 +181,7 @@ def parse_logs(fnames, parse_fn, cache_yaml):
             continue
 
     logs.sort(key=lambda l:l['timestamp'])
-    datafile.write_yaml(logs, cache_yaml)
+    datafile.write_cache(logs, cache_yaml)
 
     return logs
 
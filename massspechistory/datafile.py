@@ -14,14 +14,150 @@ import copy
 import json
 import csv
 import math
+import time
+import hashlib
 import shutil
-from collections import defaultdict
+import tempfile
+import contextlib
+import importlib
+from collections import defaultdict, OrderedDict
 
 import yaml
 
+def get_libyaml():
+    """
+    Returns the yaml module, vendored or installed, whose libyaml
+    CSafeLoader and CSafeDumper work, else None. The _yaml extension
+    builds the nodes of the installed PyYAML, so it usually fails with
+    the node classes of the vendored package.
+    """
+    modules = [yaml]
+    try:
+        modules.append(importlib.import_module('yaml'))
+    except ImportError:
+        pass
+    test_data = {'a': [1, 1.5, 'b']}
+    for module in modules:
+        if not getattr(module, '__with_libyaml__', False):
+            continue
+        try:
+            text = module.dump(test_data, Dumper=module.CSafeDumper)
+            if module.load(text, Loader=module.CSafeLoader) == test_data:
+                return module
+        except Exception:
+            pass
+    return None
+
+
+# prefer the libyaml C loader/dumper, and fall back to pure python
+libyaml = get_libyaml()
+if libyaml is not None:
+    YamlLoader = libyaml.CSafeLoader
+    YamlDumper = libyaml.CSafeDumper
+else:
+    YamlLoader = yaml.SafeLoader
+    YamlDumper = yaml.SafeDumper
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+LOCK_FNAME = '.massspechistory.lock'
+
+# Lock files are kept here, named by the directory they lock, rather
+# than in the directories, some of which are mirrored to the website
+LOCK_DIR = os.path.join(tempfile.gettempdir(), 'massspechistory-locks')
+
+
+def get_lock_path(dirname, lock_fname=LOCK_FNAME):
+    path = os.path.normcase(os.path.abspath(dirname))
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8')
+    return os.path.join(
+        LOCK_DIR, hashlib.sha1(path).hexdigest()[:16] + lock_fname)
+
+
+@contextlib.contextmanager
+def lock_dir(dirname, lock_fname=LOCK_FNAME):
+    """
+    Holds an exclusive lock on the directory, through a lock file in
+    LOCK_DIR, to serialise writers in overlapping processes on this
+    host. Locks nested in the same process need different lock_fnames.
+    """
+    if not os.path.isdir(LOCK_DIR):
+        try:
+            os.makedirs(LOCK_DIR)
+        except OSError:
+            if not os.path.isdir(LOCK_DIR):
+                raise
+    with open(get_lock_path(dirname, lock_fname), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def get_new_file_mode(fname):
+    if os.path.isfile(fname):
+        return os.stat(fname).st_mode & 0o777
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+@contextlib.contextmanager
+def atomic_open(fname, mode='w'):
+    """
+    Yields a temporary file next to fname to write into. When the
+    block finishes, the file is fsynced and renamed over fname, so a
+    crash or kill never leaves fname truncated. Writers in the same
+    directory are serialised with lock_dir.
+    """
+    dirname = os.path.dirname(os.path.abspath(fname))
+    with lock_dir(dirname):
+        fd, temp = tempfile.mkstemp(
+            dir=dirname, prefix='.' + os.path.basename(fname) + '.')
+        try:
+            with os.fdopen(fd, mode) as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(temp, get_new_file_mode(fname))
+            replace_file(temp, fname)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
 
 def write_json(logs, cache_json):
-    with open(cache_json, 'w') as f:
+    with atomic_open(cache_json) as f:
         json.dump(logs, f)
 
 
@@ -31,20 +167,28 @@ def load_json(cache_json):
 
 
 def write_jsonp(logs, cache_jsonp, callback='jsonp_callback'):
-    text = '%s(\n%s\n);' % (callback, json.dumps(logs))
-    with open(cache_jsonp, 'w') as f:
+    """
+    Writes logs as a jsonp call to callback. An existing file with
+    the same text is left untouched, so its mtime doesn't change.
+    """
+    text = '%s(\n%s\n);' % (callback, json.dumps(logs, sort_keys=True))
+    if os.path.isfile(cache_jsonp):
+        with open(cache_jsonp, 'r') as f:
+            if f.read() == text:
+                return
+    with atomic_open(cache_jsonp) as f:
         f.write(text)
 
 
 def load_yaml(cache_yaml):
     with open(cache_yaml, 'Ur') as f:
-        return yaml.load(f)
+        return yaml.load(f, Loader=YamlLoader)
 
 
 def load_cache_yaml(cache_yaml):
     if os.path.isfile(cache_yaml):
         try:
-            result = load_yaml(cache_yaml)
+            result = load_cache(cache_yaml)
         except:
             result = None
         if result is not None:
@@ -62,35 +206,169 @@ def to_dict(d):
 
 
 def write_yaml(logs, cache_yaml):
-    with open(cache_yaml, 'w') as f:
-        yaml.safe_dump(
+    with atomic_open(cache_yaml) as f:
+        yaml.dump(
             to_dict(logs),
             f,
+            Dumper=YamlDumper,
             encoding='utf-8',
             default_flow_style=False,
             allow_unicode=True)
 
 
+# format that write_cache writes caches in: 'yaml', 'json' or 'msgpack'
+# (json if msgpack isn't installed). load_cache reads any of them, so
+# existing caches are converted on their next write. json and msgpack
+# are opt-in, as the caches keep their .yaml names, and a YAML reader
+# other than load_cache would misread them, e.g. the json 1e+20 as
+# the string '1e+20'
+cache_format = 'yaml'
+
+cache_format_by_ext = {
+    '.json': 'json',
+    '.msgpack': 'msgpack',
+}
+
+# a NUL byte can't start a YAML or JSON file
+MSGPACK_HEADER = b'\x00msgpack\n'
+
+
+def get_cache_format(fname, data):
+    """
+    Returns the format of the cache fname with contents data, from
+    its header, its extension or, as JSON is also YAML and caches keep
+    their names when converted, the first character of data.
+    """
+    if data.startswith(MSGPACK_HEADER):
+        return 'msgpack'
+    ext = os.path.splitext(fname)[1].lower()
+    if ext in cache_format_by_ext:
+        return cache_format_by_ext[ext]
+    if data.lstrip()[:1] in ('{', '['):
+        return 'json'
+    return 'yaml'
+
+
+def load_cache(fname):
+    with open(fname, 'rb') as f:
+        data = f.read()
+    file_format = get_cache_format(fname, data)
+    if file_format == 'msgpack':
+        if msgpack is None:
+            raise IOError("msgpack is needed to read '%s'" % fname)
+        return msgpack.unpackb(data[len(MSGPACK_HEADER):], raw=False)
+    if file_format == 'json':
+        return json.loads(data)
+    return yaml.load(data, Loader=YamlLoader)
+
+
+def write_cache(logs, fname, file_format=None):
+    if file_format is None:
+        file_format = cache_format
+    if file_format == 'msgpack' and msgpack is None:
+        file_format = 'json'
+    if file_format == 'yaml':
+        write_yaml(logs, fname)
+        return
+    with atomic_open(fname, 'wb') as f:
+        if file_format == 'msgpack':
+            f.write(MSGPACK_HEADER)
+            f.write(msgpack.packb(logs, use_bin_type=False))
+        else:
+            json.dump(logs, f, separators=(',', ':'))
+
+
 def get_base(fname):
     return os.path.splitext(os.path.basename(fname))[0]
 
 
-def get_date_from_fname(filename, region='Australia/Melbourne'):
+def get_file_hash(fname, block_size=1<<20):
+    hasher = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def parse_yymmddhhmmss(s):
+    ints = [int(s[i:i+2]) for i in range(0, len(s), 2)]
+    ints[0] += 2000
+    return datetime(*ints)
+
+
+# run-date patterns in filenames, as (compiled regex, parse_fn) with
+# parse_fn turning the last group of the match into a naive datetime.
+# Instruments that name their runs differently get their own patterns
+# with add_date_pattern, otherwise default_date_patterns are used
+default_date_patterns = [(re.compile(r"(\d{12})"), parse_yymmddhhmmss)]
+date_patterns_by_instrument = {}
+
+# memo of get_date_from_fname, bounded to the most recently used dates
+date_cache = OrderedDict()
+max_date_cache = 20000
+
+tz_by_region = {}
+
+
+def add_date_pattern(instrument, regex, parse_fn=parse_yymmddhhmmss):
+    patterns = date_patterns_by_instrument.setdefault(instrument, [])
+    patterns.append((re.compile(regex), parse_fn))
+    date_cache.clear()
+
+
+def get_timezone(region):
+    if region not in tz_by_region:
+        tz_by_region[region] = timezone(region)
+    return tz_by_region[region]
+
+
+def get_instrument_from_fname(filename):
+    """
+    Returns the instrument directory above instrument_data in filename,
+    e.g. '../qeplus/instrument_data/hela_170101110000.raw' -> 'qeplus'.
+    """
+    parts = os.path.normpath(filename).replace('\\', '/').split('/')
+    if 'instrument_data' in parts:
+        i = parts.index('instrument_data')
+        if i > 0:
+            return parts[i - 1]
+    return None
+
+
+def parse_date_from_fname(filename, region, instrument):
+    if instrument is None:
+        instrument = get_instrument_from_fname(filename)
+    patterns = date_patterns_by_instrument.get(
+        instrument, default_date_patterns)
+    for regex, parse_fn in patterns:
+        match = regex.search(filename)
+        if match:
+            unaware_date = parse_fn(match.groups()[-1])
+            aware_date = get_timezone(region).localize(unaware_date)
+            return aware_date.astimezone(UTC)
+    return None
+
+
+def get_date_from_fname(
+        filename, region='Australia/Melbourne', instrument=None):
     """
     Returns a UTC date that is derived from the
     location given in region. This allows proper UNIX
     timestamps to be generated from the datetime object.
+
+    The filename pattern is looked up for instrument, by default
+    the directory above instrument_data. Dates are memoised, as the
+    same filenames are parsed over and over.
     """
-    match = re.search("(\d{12})", filename)
-    if match:
-        s = match.groups()[-1]
-        ints = [int(s[i:i+2]) for i in range(0, len(s), 2)]
-        ints[0] += 2000
-        unaware_date = datetime(*ints)
-        aware_date = timezone(region).localize(unaware_date)
-        return aware_date.astimezone(UTC)
+    key = (filename, region, instrument)
+    if key in date_cache:
+        date = date_cache.pop(key)
     else:
-        return None
+        date = parse_date_from_fname(filename, region, instrument)
+        if len(date_cache) >= max_date_cache:
+            date_cache.popitem(last=False)
+    date_cache[key] = date
+    return date
 
 
 float_regex_pattern = r"""
@@ -127,6 +405,29 @@ def get_avg_std(values):
     return avg, std
 
 
+class RunningAvgStd(object):
+    """
+    Accumulates the average and standard deviation of a stream
+    of values (Welford's method), so that the values themselves
+    never have to be kept in memory.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.avg = 0.0
+        self.sum_sq = 0.0
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.avg
+        self.avg += delta / self.n
+        self.sum_sq += delta * (value - self.avg)
+
+    def get_avg_std(self):
+        var = self.sum_sq / float(self.n)
+        return self.avg, math.sqrt(var)
+
+
 def guess_delimiter(fname):
     if os.path.isfile(fname):
         with open(fname, 'Ur') as f:
@@ -161,6 +462,29 @@ def read_csv(fname):
         return list(csv.DictReader(f, delimiter=delimiter))
 
 
+def iter_csv_columns(fname, columns):
+    """
+    Yields a tuple of the values in `columns` for every row of
+    the csv file. The column indexes are resolved once from the
+    header, and rows are streamed rather than read into a list
+    of dicts.
+    """
+    delimiter = guess_delimiter(fname)
+    with open(fname, 'Ur') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        headers = reader.next()
+        indices = []
+        for column in columns:
+            if column not in headers:
+                raise KeyError(column)
+            indices.append(headers.index(column))
+        n_column = max(indices) + 1
+        for row in reader:
+            if len(row) < n_column:
+                continue
+            yield tuple(row[i] for i in indices)
+
+
 def write_csv(rows, csv_fname):
     delimiter = guess_delimiter(csv_fname)
     with open(csv_fname, 'w') as f:
@@ -176,12 +500,144 @@ def glob_re(glob_tag, regex=None):
     return fnames
 
 
-def copy_dir(in_dir, out_dir):
+class SettlingFiles(object):
+    """
+    Files that may still be being written, e.g. a RAW file that the
+    instrument is acquiring or robocopy is copying. A file has settled
+    when it has been seen with the same size and mtime at least
+    settle_time seconds apart. Files whose mtime is more than
+    settled_age seconds old when first seen, e.g. the archive on the
+    first batch, have settled without waiting. The state, fname ->
+    [size, mtime, time first seen so], is kept once a file has
+    settled, so that it stays settled until it changes, and can be
+    saved as json.
+    """
+
+    def __init__(self, settle_time=60, state=None, settled_age=24*3600):
+        self.settle_time = settle_time
+        self.settled_age = settled_age
+        self.state = {} if state is None else state
+        self.pending = set()
+
+    def add(self, fname):
+        self.pending.add(fname)
+
+    def is_settled(self, fname, now=None):
+        if now is None:
+            now = time.time()
+        entry = self.state.get(fname)
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            self.state.pop(fname, None)
+            return False
+        if entry is None:
+            if now - stat.st_mtime >= self.settled_age:
+                return True
+            self.state[fname] = [stat.st_size, stat.st_mtime, now]
+            return False
+        if entry[0] != stat.st_size or entry[1] != stat.st_mtime:
+            self.state[fname] = [stat.st_size, stat.st_mtime, now]
+            return False
+        return now - entry[2] >= self.settle_time
+
+    def pop_settled(self, now=None):
+        """
+        Returns the added files that have settled, and stops watching
+        them. Files that have disappeared are dropped.
+        """
+        settled = []
+        for fname in sorted(self.pending):
+            if self.is_settled(fname, now):
+                settled.append(fname)
+                self.pending.discard(fname)
+            elif fname not in self.state:
+                self.pending.discard(fname)
+        self.prune(now)
+        return settled
+
+    def prune(self, now=None):
+        """
+        Forgets the files whose mtime is past settled_age, which have
+        settled without their state.
+        """
+        if now is None:
+            now = time.time()
+        for fname, entry in list(self.state.items()):
+            if fname not in self.pending \
+                    and now - entry[1] >= self.settled_age:
+                del self.state[fname]
+
+
+def replace_file(src, dst):
+    """
+    Renames src to dst, replacing dst atomically where the platform
+    allows it (not on Windows with python 2).
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def atomic_copy(src, dst):
+    """
+    Copies src with its mtime to a temporary file next to dst, then
+    renames it over dst, so dst is never seen half-written.
+    """
+    fd, temp = tempfile.mkstemp(
+        dir=os.path.dirname(dst) or '.',
+        prefix='.' + os.path.basename(dst) + '.')
+    os.close(fd)
+    try:
+        shutil.copy2(src, temp)
+        replace_file(temp, dst)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def is_same_file(src, dst, is_hash=False):
+    """
+    Returns True if dst has the size and mtime (to within the 2 s
+    resolution of FAT and some Samba shares) of src or, if is_hash,
+    the same content.
+    """
+    if not os.path.isfile(dst):
+        return False
+    src_stat = os.stat(src)
+    dst_stat = os.stat(dst)
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if is_hash:
+        return get_file_hash(src) == get_file_hash(dst)
+    return abs(src_stat.st_mtime - dst_stat.st_mtime) < 2
+
+
+def copy_dir(in_dir, out_dir, is_sync=False, is_hash=False):
+    """
+    Copies in_dir recursively to out_dir. With is_sync, files already in
+    out_dir that are the same (see is_same_file) are skipped, and
+    changed files are copied atomically with their mtimes, so that
+    later mirroring of out_dir only sees files that really changed.
+    """
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
     for f in glob.glob(os.path.join(in_dir, '*')):
         if os.path.isfile(f):
-            shutil.copy(f, out_dir)
+            if not is_sync:
+                shutil.copy(f, out_dir)
+                continue
+            target = os.path.join(out_dir, os.path.basename(f))
+            if not is_same_file(f, target, is_hash):
+                atomic_copy(f, target)
         else:
             target_dir = os.path.join(out_dir, os.path.basename(f))
-            copy_dir(f, target_dir)
+            copy_dir(f, target_dir, is_sync, is_hash)
@@ -0,0 +1,215 @@
+
+
+__doc__ = """
+Single-pass scanner of an instrument directory, which classifies every
+file by digest (hela/ecoli), run date and kind (raw, summary, psms,
+irt) instead of globbing the same share over and over.
+
+The scan is persisted in an index of the directories with their mtimes,
+so that later scans only list the directories whose mtime changed, and
+only stat the others. Adding, removing or renaming a file changes the
+mtime of its directory, which is all that discovery needs; the log
+parsers fingerprint the files themselves.
+"""
+
+import os
+import re
+import time
+import calendar
+import fnmatch
+import logging
+
+import datafile
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+logger = logging.getLogger('fileindex')
+
+
+digest_patterns = [
+    ('hela', re.compile(r"\b(Hela|hela)")),
+    ('ecoli', re.compile(r"\b(E|e)coli")),
+]
+
+# case-insensitive, as instruments and copies via Windows shares
+# write e.g. .RAW as well as .raw
+kind_patterns = [
+    ('raw', re.compile(r"\.raw$", re.I)),
+    ('summary', re.compile(r"(^|/)summary\.tsv$", re.I)),
+    ('psms', re.compile(r"PSMs\.tsv$", re.I)),
+    ('irt', re.compile(r"(Hela|hela|ecoli).*iRT[^/]*\.txt$", re.I)),
+]
+
+# bumped when the classification changes, to rescan old indexes
+index_version = 2
+
+# directory mtimes closer than this to the scan are not trusted, as a
+# file added in the same tick (2 s on FAT and some Samba shares) would
+# not change the mtime again
+mtime_resolution = 2
+
+
+def match_first(patterns, path):
+    for name, regex in patterns:
+        if regex.search(path):
+            return name
+    return None
+
+
+def classify(path, fname):
+    """
+    Returns the entry in the index of the file fname at the relative
+    path (with '/' separators).
+    """
+    date = datafile.get_date_from_fname(fname)
+    return {
+        'kind': match_first(kind_patterns, path),
+        'digest': match_first(digest_patterns, path),
+        'timestamp': calendar.timegm(date.timetuple()) if date else None,
+    }
+
+
+def list_dir(dirname):
+    """
+    Returns (fnames, subdirs) of dirname. scandir gets the type of the
+    entries from the directory listing, without a stat per entry.
+    """
+    fnames = []
+    subdirs = []
+    if scandir is not None:
+        for entry in scandir(dirname):
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                fnames.append(entry.name)
+    else:
+        for name in os.listdir(dirname):
+            if os.path.isdir(os.path.join(dirname, name)):
+                subdirs.append(name)
+            elif os.path.isfile(os.path.join(dirname, name)):
+                fnames.append(name)
+    return sorted(fnames), sorted(subdirs)
+
+
+def join_rel(rel_dir, name):
+    return rel_dir + '/' + name if rel_dir else name
+
+
+def match_path(pattern, path):
+    """
+    Matches the relative path against a glob pattern segment by
+    segment, so that '*' doesn't match '/', as in glob.glob. As in
+    glob.glob, the match is case-insensitive on Windows.
+    """
+    pattern_parts = pattern.split('/')
+    path_parts = path.split('/')
+    if len(pattern_parts) != len(path_parts):
+        return False
+    for pattern_part, path_part in zip(pattern_parts, path_parts):
+        if not fnmatch.fnmatch(path_part, pattern_part):
+            return False
+    return True
+
+
+class FileIndex(object):
+    """
+    The files under root_dir, by relative path, persisted in index_json.
+    Directories in skip_dirs, e.g. the website directory, are not
+    scanned.
+    """
+
+    def __init__(self, root_dir, index_json=None, skip_dirs=[]):
+        self.root_dir = root_dir
+        self.index_json = index_json
+        self.skip_dirs = [os.path.abspath(d) for d in skip_dirs]
+        self.dirs = {}
+        self.files = {}
+
+    def get_path(self, path):
+        if not path:
+            return self.root_dir
+        return os.path.join(self.root_dir, *path.split('/'))
+
+    def load(self):
+        if self.index_json and os.path.isfile(self.index_json):
+            try:
+                index = datafile.load_json(self.index_json)
+            except ValueError:
+                logger.warning("Ignoring corrupt index " + self.index_json)
+                return {}
+            if index.get('version') == index_version:
+                return index['dirs']
+        return {}
+
+    def scan(self):
+        prev_dirs = self.dirs or self.load()
+        scan_time = time.time()
+        self.dirs = {}
+        self.files = {}
+        n_listed = 0
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            dirname = self.get_path(rel_dir)
+            if os.path.abspath(dirname) in self.skip_dirs:
+                continue
+            try:
+                mtime = os.stat(dirname).st_mtime
+            except OSError:
+                continue
+            prev = prev_dirs.get(rel_dir)
+            if prev is not None and prev['mtime'] == mtime:
+                entry = prev
+            else:
+                try:
+                    fnames, subdirs = list_dir(dirname)
+                except OSError as e:
+                    logger.warning("Can't list %s: %s" % (dirname, e))
+                    continue
+                n_listed += 1
+                files = {}
+                for fname in fnames:
+                    path = join_rel(rel_dir, fname)
+                    files[fname] = classify(path, self.get_path(path))
+                if scan_time - mtime < mtime_resolution:
+                    mtime = None
+                entry = {'mtime': mtime, 'files': files, 'dirs': subdirs}
+            self.dirs[rel_dir] = entry
+            for fname, file_entry in entry['files'].items():
+                self.files[join_rel(rel_dir, fname)] = file_entry
+            for subdir in entry['dirs']:
+                stack.append(join_rel(rel_dir, subdir))
+        logger.debug(
+            "Scanned %s: listed %d of %d directories" %
+            (self.root_dir, n_listed, len(self.dirs)))
+        if self.index_json and self.dirs != prev_dirs:
+            datafile.write_json(
+                {'version': index_version, 'dirs': self.dirs},
+                self.index_json)
+        return self
+
+    def find(self, pattern=None, kind=None, digest=None, is_dated=False):
+        """
+        Returns the paths, joined to root_dir, of the files matching the
+        glob pattern (relative to root_dir, with '/' separators), kind,
+        digest and, if is_dated, with a run date.
+        """
+        result = []
+        for path, entry in self.files.items():
+            if kind is not None and entry['kind'] != kind:
+                continue
+            if digest is not None and entry['digest'] != digest:
+                continue
+            if is_dated and entry['timestamp'] is None:
+                continue
+            if pattern is not None and not match_path(pattern, path):
+                continue
+            result.append(self.get_path(path))
+        return sorted(result)
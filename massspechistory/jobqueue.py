@@ -0,0 +1,214 @@
+
+
+__doc__ = """
+Persistent priority queue of Morpheus searches, shared by the batches
+of all instruments and digests (and overlapping processes) through a
+json file.
+
+Searches are popped newest run first, by the run date in the filename.
+Runs newer than fresh_age are fresh QC, older ones are backfill.
+Backfill is only popped when no fresh search is waiting, and may only
+take a limited number of the search slots, so that, with more than
+one slot, there is always a slot for a fresh run. As the queue is re-read on every pop, a fresh run
+queued by another batch goes ahead of any backfill that hasn't started.
+
+A popped search stays in the queue, marked with the host, pid and
+start time of the process running it, until it finishes, so that an
+overlapping batch doesn't queue it again.
+"""
+
+import os
+import copy
+import time
+import errno
+import socket
+import platform
+import calendar
+import contextlib
+import logging
+
+import datafile
+
+
+logger = logging.getLogger('jobqueue')
+
+
+# seconds since its run date for which a search is fresh QC rather
+# than backfill
+fresh_age = 2*24*3600
+
+# seconds after which a running search is taken to have died, if its
+# process can't be checked, i.e. on another host or on Windows
+max_run_time = 12*3600
+
+
+def get_timestamp(fname):
+    date = datafile.get_date_from_fname(fname)
+    if date is None:
+        return None
+    return calendar.timegm(date.timetuple())
+
+
+def is_fresh(entry, now=None):
+    if now is None:
+        now = time.time()
+    timestamp = entry['timestamp']
+    return timestamp is not None and now - timestamp < fresh_age
+
+
+def get_instrument(entry):
+    return datafile.get_instrument_from_fname(entry['options']['-d'])
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def is_running(entry, now=None):
+    """
+    Returns True if the search of entry has been popped by a process
+    that is still running.
+    """
+    if entry.get('pid') is None:
+        return False
+    if now is None:
+        now = time.time()
+    # os.kill would terminate the process on Windows
+    if entry['host'] == socket.gethostname() \
+            and platform.system() != 'Windows':
+        return is_process_alive(entry['pid'])
+    return now - entry['start_time'] < max_run_time
+
+
+class JobQueue(object):
+    """
+    The queued searches in queue_json, by absolute output directory,
+    as {'options', 'key', 'cache_json', 'timestamp'}, where key and
+    cache_json are where the result is recorded, see morpheus.batch,
+    and 'pid', 'host' and 'start_time' once popped.
+    """
+
+    def __init__(self, queue_json):
+        self.queue_json = os.path.abspath(queue_json)
+        self.lock_fname = '.' + os.path.basename(queue_json) + '.lock'
+
+    def load(self):
+        if os.path.isfile(self.queue_json):
+            try:
+                return datafile.load_json(self.queue_json)
+            except ValueError:
+                logger.error("Ignoring corrupt " + self.queue_json)
+        return {}
+
+    @contextlib.contextmanager
+    def edit(self):
+        """
+        Yields the entries for changing, under a lock, and saves them
+        if they were changed.
+        """
+        dirname = os.path.dirname(self.queue_json)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with datafile.lock_dir(dirname, self.lock_fname):
+            entries = self.load()
+            prev_entries = copy.deepcopy(entries)
+            yield entries
+            if entries != prev_entries:
+                datafile.write_json(entries, self.queue_json)
+
+    def get_running_out_dirs(self):
+        now = time.time()
+        entries = self.load()
+        return set(d for d in entries if is_running(entries[d], now))
+
+    def update(self, jobs, out_dirs):
+        """
+        Replaces the searches into out_dirs with jobs, a list of
+        (options, key, cache_json). Searches into out_dirs that are no
+        longer needed are dropped. Running searches are left alone.
+        """
+        now = time.time()
+        with self.edit() as entries:
+            for out_dir in out_dirs:
+                out_dir = os.path.abspath(out_dir)
+                if out_dir in entries \
+                        and not is_running(entries[out_dir], now):
+                    del entries[out_dir]
+            for options, key, cache_json in jobs:
+                options = dict(options)
+                options['-d'] = os.path.abspath(options['-d'])
+                options['-o'] = os.path.abspath(options['-o'])
+                if options['-o'] in entries:
+                    continue
+                entries[options['-o']] = {
+                    'options': options,
+                    'key': key,
+                    'cache_json': os.path.abspath(cache_json),
+                    'timestamp': get_timestamp(options['-d']),
+                }
+
+    def pop(self, n_fresh_job=1, n_backfill_job=1, instruments=None):
+        """
+        Returns the most urgent search that can start, marked as run by
+        this process, else None. A fresh search can start while fewer
+        than n_fresh_job fresh searches are running, and a backfill
+        search while no fresh search is waiting and fewer than
+        n_backfill_job backfill searches are running. If instruments
+        are given, only searches of their data files are popped.
+        """
+        now = time.time()
+        with self.edit() as entries:
+            n_fresh_running = 0
+            n_backfill_running = 0
+            fresh_dirs = []
+            backfill_dirs = []
+            for out_dir, entry in entries.items():
+                if is_running(entry, now):
+                    if is_fresh(entry, now):
+                        n_fresh_running += 1
+                    else:
+                        n_backfill_running += 1
+                elif instruments is not None and \
+                        get_instrument(entry) not in instruments:
+                    continue
+                elif is_fresh(entry, now):
+                    fresh_dirs.append(out_dir)
+                else:
+                    backfill_dirs.append(out_dir)
+            if fresh_dirs:
+                if n_fresh_running >= n_fresh_job:
+                    return None
+                out_dirs = fresh_dirs
+            elif backfill_dirs:
+                if n_backfill_running >= n_backfill_job:
+                    return None
+                out_dirs = backfill_dirs
+            else:
+                return None
+            out_dir = max(
+                out_dirs, key=lambda d: entries[d]['timestamp'] or 0)
+            entry = entries[out_dir]
+            entry['pid'] = os.getpid()
+            entry['host'] = socket.gethostname()
+            entry['start_time'] = now
+        logger.debug("Popped %s search of %s, %d waiting" % (
+            'fresh' if out_dirs is fresh_dirs else 'backfill',
+            datafile.get_base(entry['options']['-d']), len(out_dirs) - 1))
+        return entry
+
+    def finish(self, out_dir):
+        """
+        Removes the search into out_dir, popped by this process.
+        """
+        with self.edit() as entries:
+            entry = entries.get(out_dir)
+            if entry is not None and entry.get('pid') == os.getpid() \
+                    and entry.get('host') == socket.gethostname():
+                del entries[out_dir]
+
+    def __len__(self):
+        return len(self.load())
@@ -0,0 +1,121 @@
+
+
+__doc__ = """
+Storage backends for the parsed logs cached by chart.parse_logs.
+
+The logs were originally cached in a YAML file that was reloaded
+and completely rewritten on every run. The default 'sqlite' backend
+keeps the logs in a SQLite database next to the YAML cache (e.g.
+msms.logs.yaml -> msms.logs.sqlite), keyed by fname, so that new logs
+are appended in a transaction and old logs are never re-serialised.
+An existing YAML cache is imported the first time the database is
+opened.
+"""
+
+import os
+import json
+import sqlite3
+import logging
+
+import datafile
+
+
+logger = logging.getLogger('logcache')
+
+
+class YamlLogCache(object):
+    """
+    The original cache: the whole list of logs in one file, in
+    datafile.cache_format, under the original YAML name.
+    """
+
+    def __init__(self, cache_yaml):
+        self.cache_yaml = cache_yaml
+
+    def load(self):
+        if os.path.isfile(self.cache_yaml):
+            logs = datafile.load_cache(self.cache_yaml)
+        else:
+            logs = []
+        if logs is None:
+            logs = []
+        return logs
+
+    def write(self, logs, new_logs):
+        datafile.write_cache(logs, self.cache_yaml)
+
+
+class SqliteLogCache(object):
+    """
+    One row per log, keyed by fname, with the timestamp indexed
+    and the parsed metrics stored as a JSON blob.
+    """
+
+    def __init__(self, cache_yaml):
+        self.cache_yaml = cache_yaml
+        self.cache_db = os.path.splitext(cache_yaml)[0] + '.sqlite'
+
+    def connect(self):
+        conn = sqlite3.connect(self.cache_db)
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS logs ('
+                'fname TEXT PRIMARY KEY, '
+                'timestamp INTEGER, '
+                'log TEXT)')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS logs_timestamp '
+                'ON logs (timestamp)')
+        return conn
+
+    def is_empty(self, conn):
+        return conn.execute('SELECT COUNT(*) FROM logs').fetchone()[0] == 0
+
+    def insert(self, conn, logs):
+        rows = []
+        for log in logs:
+            rows.append((log['fname'], log.get('timestamp'), json.dumps(log)))
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO logs VALUES (?, ?, ?)', rows)
+
+    def import_yaml(self, conn):
+        logs = YamlLogCache(self.cache_yaml).load()
+        logs = [log for log in logs if 'fname' in log]
+        logger.info(
+            "Importing %d logs from %s" % (len(logs), self.cache_yaml))
+        self.insert(conn, logs)
+
+    def load(self):
+        conn = self.connect()
+        try:
+            if self.is_empty(conn) and os.path.isfile(self.cache_yaml):
+                self.import_yaml(conn)
+            rows = conn.execute(
+                'SELECT log FROM logs ORDER BY timestamp').fetchall()
+        finally:
+            conn.close()
+        return [json.loads(row[0]) for row in rows]
+
+    def write(self, logs, new_logs):
+        if not new_logs:
+            return
+        conn = self.connect()
+        try:
+            self.insert(conn, new_logs)
+        finally:
+            conn.close()
+
+
+backends = {
+    'yaml': YamlLogCache,
+    'sqlite': SqliteLogCache,
+}
+
+default_backend = 'sqlite'
+
+
+def get_log_cache(cache_yaml, backend=None):
+    if backend is None:
+        backend = default_backend
+    return backends[backend](cache_yaml)
@@ -8,8 +8,14 @@ import shutil
 import platform
 import logging
 import time
+import subprocess
+import multiprocessing
+import tempfile
+import hashlib
+import json
 
 import datafile
+import jobqueue
 
 
 logger = logging.getLogger('morpheus')
@@ -18,13 +24,23 @@ ROOT_DIR = os.path.dirname(__file__)
 MORPHEUS_DIR = os.path.join(ROOT_DIR, 'morpheus', 'standard')
 MORPHEUS_THERMO_DIR = os.path.join(ROOT_DIR, 'morpheus', 'thermo')
 
+# Staged copies of the Morpheus directories, with local tsv files
+# merged in, are cached here by content hash
+STAGE_DIR = os.path.join(tempfile.gettempdir(), 'massspechistory-morpheus')
+
+# Local tsv files in the current directory that are merged into the
+# defaults of Morpheus
+LOCAL_TSVS = ['modifications.tsv', 'proteases.tsv', 'amino_acids.tsv']
+
 
 __doc__ = """
 Morpheus proteomics search engine wrapper in python
 
 If a 'modifications.tsv' file is found in the current directory,
 will add that to the default 'modifictions.tsv' found in the
-morpheus directory.
+morpheus directory. Likewise for 'proteases.tsv' and 'amino_acids.tsv'.
+The merged files are placed in a staged copy of the morpheus
+directory, so the bundled files are never modified.
 
 Usage: morpheus.py [options]
 
@@ -62,36 +78,162 @@ Usage: morpheus.py [options]
 """
 
 
-def get_morpheus_bin(is_thermo=False):
+def get_morpheus_dir(is_thermo=False):
     if not is_thermo:
-        cmd = os.path.join(MORPHEUS_DIR, 'morpheus_cl.exe')
+        return MORPHEUS_DIR
     else:
-        cmd = os.path.join(MORPHEUS_THERMO_DIR, 'morpheus_tmo_cl.exe')
-    if platform.system() != 'Windows':
-        cmd = 'mono ' + cmd
-    return cmd
+        return MORPHEUS_THERMO_DIR
 
 
-def get_modifications_tsv(is_thermo=False):
+def get_morpheus_exe(is_thermo=False, morpheus_dir=None):
+    if morpheus_dir is None:
+        morpheus_dir = get_morpheus_dir(is_thermo)
     if not is_thermo:
-        return os.path.join(MORPHEUS_DIR, 'modifications.tsv')
+        return os.path.join(morpheus_dir, 'morpheus_cl.exe')
     else:
-        return os.path.join(MORPHEUS_THERMO_DIR, 'modifications.tsv')
+        return os.path.join(morpheus_dir, 'morpheus_tmo_cl.exe')
+
+
+def get_modifications_tsv(is_thermo=False, morpheus_dir=None):
+    if morpheus_dir is None:
+        morpheus_dir = get_morpheus_dir(is_thermo)
+    return os.path.join(morpheus_dir, 'modifications.tsv')
+
+
+def merge_tsv(default_tsv, extra_tsv):
+    """
+    Returns the text of default_tsv with the rows of extra_tsv
+    whose first column is not already in default_tsv.
+    """
+    with open(default_tsv, 'Ur') as f:
+        lines = f.readlines()
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    default_keys = [line.split('\t')[0] for line in lines[1:]]
+    logger.debug("Adding %s to %s" % (extra_tsv, default_tsv))
+    with open(extra_tsv, 'Ur') as f:
+        for line in f.readlines()[1:]:
+            key = line.split('\t')[0]
+            if key not in default_keys:
+                lines.append(line)
+    return ''.join(lines)
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        shutil.copy2(src, dst)
+
+
+def is_staged(staged_dir, morpheus_dir, tsv_texts):
+    """
+    Returns True if staged_dir has every file of morpheus_dir, and the
+    merged tsv files in tsv_texts, as the system temp directory may be
+    partly cleaned out, e.g. by tmpreaper or Disk Cleanup.
+    """
+    if not os.path.isdir(staged_dir):
+        return False
+    for fname in os.listdir(morpheus_dir):
+        if os.path.isfile(os.path.join(morpheus_dir, fname)) \
+                and not os.path.isfile(os.path.join(staged_dir, fname)):
+            return False
+    for tsv, text in tsv_texts.items():
+        try:
+            with open(os.path.join(staged_dir, tsv)) as f:
+                if f.read() != text:
+                    return False
+        except IOError:
+            return False
+    return True
+
+
+def stage_morpheus_dir(is_thermo=False):
+    """
+    Returns a private copy of the morpheus directory with the local
+    tsv files merged in. The copy is keyed by the hash of its tsv
+    files, so it is built once, and then shared by any concurrent
+    searches that use the same tsv files. A copy with missing files is
+    staged again. The bundled directory is never modified, so a
+    crashed search leaves nothing to restore.
+    """
+    morpheus_dir = get_morpheus_dir(is_thermo)
+
+    tsv_texts = {}
+    for tsv in LOCAL_TSVS:
+        default_tsv = os.path.join(morpheus_dir, tsv)
+        if os.path.isfile(tsv) and os.path.isfile(default_tsv):
+            tsv_texts[tsv] = merge_tsv(default_tsv, tsv)
+    if not tsv_texts:
+        return morpheus_dir
+
+    hasher = hashlib.sha1(os.path.basename(morpheus_dir).encode('utf-8'))
+    for tsv in sorted(tsv_texts):
+        hasher.update(tsv.encode('utf-8'))
+        hasher.update(tsv_texts[tsv].encode('utf-8'))
+    staged_dir = os.path.join(
+        STAGE_DIR,
+        os.path.basename(morpheus_dir) + '-' + hasher.hexdigest()[:16])
+    if is_staged(staged_dir, morpheus_dir, tsv_texts):
+        return staged_dir
+
+    if os.path.isdir(staged_dir):
+        logger.info("Restaging incomplete " + staged_dir)
+        # moved aside first, as rmtree isn't atomic
+        old_dir = tempfile.mkdtemp(dir=STAGE_DIR)
+        try:
+            os.rename(staged_dir, os.path.join(old_dir, 'old'))
+        except OSError:
+            # another search moved it first
+            pass
+        shutil.rmtree(old_dir, ignore_errors=True)
 
+    if not os.path.isdir(STAGE_DIR):
+        try:
+            os.makedirs(STAGE_DIR)
+        except OSError:
+            if not os.path.isdir(STAGE_DIR):
+                raise
+
+    # build in a temporary directory then rename, so that other
+    # searches never see a partially staged directory
+    build_dir = tempfile.mkdtemp(dir=STAGE_DIR)
+    try:
+        for fname in os.listdir(morpheus_dir):
+            src = os.path.join(morpheus_dir, fname)
+            if fname in tsv_texts or not os.path.isfile(src):
+                continue
+            link_or_copy(src, os.path.join(build_dir, fname))
+        for tsv, text in tsv_texts.items():
+            with open(os.path.join(build_dir, tsv), 'w') as f:
+                f.write(text)
+        os.rename(build_dir, staged_dir)
+        logger.debug("Staged morpheus in " + staged_dir)
+    except OSError:
+        # another search staged the same directory first
+        if not os.path.isdir(staged_dir):
+            raise
+    finally:
+        if os.path.isdir(build_dir):
+            shutil.rmtree(build_dir)
 
-def add_modifications(modifications_tsv, extra_modifications_tsv):
-    mods = list(datafile.read_csv(modifications_tsv))
-    default_mods = [mod['Description'] for mod in mods]
-    logger.debug("Adding %s to %s" % (extra_modifications_tsv, modifications_tsv))
-    new_mod_lines = []
-    with open(extra_modifications_tsv, 'Ur') as f:
-        for line in f.readlines()[1:]:
-            mod = line.split('\t')[0]
-            if mod not in default_mods:
-                new_mod_lines.append(line)
-    with open(modifications_tsv, 'a') as f:
-        for line in new_mod_lines:
-            f.write(line)
+    return staged_dir
+
+
+staged_morpheus_dirs = {}
+
+
+def get_staged_morpheus_dir(is_thermo=False):
+    """
+    Returns the directory of stage_morpheus_dir, memoised for the
+    process while its Morpheus binary is there.
+    """
+    staged_dir = staged_morpheus_dirs.get(is_thermo)
+    if staged_dir is None \
+            or not os.path.isfile(get_morpheus_exe(is_thermo, staged_dir)):
+        staged_dir = stage_morpheus_dir(is_thermo)
+        staged_morpheus_dirs[is_thermo] = staged_dir
+    return staged_dir
 
 
 def print_modifications(modifications_tsv):
@@ -100,10 +242,28 @@ def print_modifications(modifications_tsv):
     logger.debug('modifications: %s' % mods)
 
 
-def run(options):
-    is_thermo = False
+def get_morpheus_cmd(options, morpheus_dir=None):
+    is_thermo = is_thermo_options(options)
+    cmd = [get_morpheus_exe(is_thermo, morpheus_dir)]
+    if platform.system() != 'Windows':
+        cmd.insert(0, 'mono')
+    for key in options:
+        cmd.extend([key, str(options[key])])
+    return cmd
+
+
+def is_thermo_options(options):
     if '-d' in options:
-        is_thermo = options['-d'].strip().lower().endswith('raw')
+        return options['-d'].strip().lower().endswith('raw')
+    return False
+
+
+def start(options):
+    """
+    Launches Morpheus with options without waiting, and returns the
+    subprocess.Popen object.
+    """
+    is_thermo = is_thermo_options(options)
 
     logger.debug("options: %s" % options)
 
@@ -113,30 +273,20 @@ def run(options):
             logger.debug("Creating output directory " + d)
             os.makedirs(d)
 
-    default_modifications_tsv = get_modifications_tsv(is_thermo)
-
-    backup_modifications_tsv = None
-    if os.path.isfile('modifications.tsv'):
-        backup_modifications_tsv = default_modifications_tsv + '.backup'
-        shutil.copy(default_modifications_tsv, backup_modifications_tsv)
-        add_modifications(default_modifications_tsv, 'modifications.tsv')
+    morpheus_dir = get_staged_morpheus_dir(is_thermo)
+    print_modifications(get_modifications_tsv(is_thermo, morpheus_dir))
 
-    print_modifications(default_modifications_tsv)
-
-    option_str = ''
-    for key in options:
-        option_str += ' %s \'%s\'' % (key, options[key])
-
-    cmd = get_morpheus_bin(is_thermo) + ' ' + option_str
+    cmd = get_morpheus_cmd(options, morpheus_dir)
     prompt = "morpheus: "
     if is_thermo:
         prompt = "morpheus(raw): "
     logger.info(prompt + datafile.get_base(options['-d']))
-    logger.debug(cmd)
-    os.system(cmd)
+    logger.debug(' '.join(cmd))
+    return subprocess.Popen(cmd)
 
-    if backup_modifications_tsv:
-        shutil.copy(backup_modifications_tsv, default_modifications_tsv)
+
+def run(options):
+    return start(options).wait()
 
 
 def get_args_from_doc(doc):
@@ -165,47 +315,381 @@ def is_good_morpheus_output(out_dir):
     return is_summary and is_psm and len(fnames) >= 6
 
 
-def batch(fnames, out_dir_fn, options={'-ad':'true','-mmu':'true'}, dummy=False):
-    for fname in fnames:
-        if not datafile.get_date_from_fname(fname):
-            continue
-        out_dir = out_dir_fn(fname)
-        if os.path.isdir(out_dir):
-            if is_good_morpheus_output(out_dir):
-                logger.debug("Skipping " + datafile.get_base(out_dir))
+def format_time(c):
+    hours = c // 3600 % 24
+    minutes = c // 60 % 60
+    seconds = c % 60
+    return "%d:%02d:%04.1f" % (hours, minutes, seconds)
+
+
+def run_jobs(jobs, n_job=1, n_thread=None, poll_interval=5, finish_fn=None):
+    """
+    Runs Morpheus for every options dict in jobs, with at most n_job
+    searches at a time. The n_thread processor threads (default: all)
+    are split between the concurrent searches with -mt. Returns a
+    list of (options, seconds, is_good) for the jobs.
+
+    jobs can also be a function that returns the next options dict,
+    or None when there is none to start yet, which is called whenever
+    a search can be started, and every poll_interval. The run ends
+    when it returns None with no search running. finish_fn, if given,
+    is called with the (options, seconds, is_good) of every job as it
+    finishes.
+    """
+    if n_thread is None:
+        n_thread = multiprocessing.cpu_count()
+    n_job = max(1, n_job)
+    n_thread_per_job = max(1, n_thread // n_job)
+
+    if callable(jobs):
+        pop_job = jobs
+    else:
+        pending_jobs = list(jobs)
+        pop_job = lambda: pending_jobs.pop(0) if pending_jobs else None
+    running_jobs = []
+    timings = []
+
+    def finish(timing):
+        timings.append(timing)
+        if finish_fn is not None:
+            finish_fn(*timing)
+
+    try:
+        while True:
+
+            while len(running_jobs) < n_job:
+                options = pop_job()
+                if options is None:
+                    break
+                if n_job > 1 and '-mt' not in options:
+                    options['-mt'] = str(n_thread_per_job)
+                out_dir = options['-o']
+                try:
+                    if os.path.isdir(out_dir):
+                        shutil.rmtree(out_dir)
+                    process = start(options)
+                except KeyboardInterrupt:
+                    raise
+                except Exception as e:
+                    logger.error(
+                        "failed: %s: %s" % (datafile.get_base(out_dir), e))
+                    finish((options, 0, False))
+                    continue
+                running_jobs.append((options, process, time.time()))
+
+            if not running_jobs:
+                break
+
+            finished_jobs = [
+                job for job in running_jobs if job[1].poll() is not None]
+            if not finished_jobs:
+                time.sleep(poll_interval)
                 continue
-        if dummy:
-            continue
-        try:
-            start = time.time()
 
-            if os.path.isdir(out_dir):
-                shutil.rmtree(out_dir)
+            for job in finished_jobs:
+                running_jobs.remove(job)
+                options, process, start_time = job
+                out_dir = options['-o']
+                c = time.time() - start_time
+                is_good = os.path.isdir(out_dir) and \
+                    is_good_morpheus_output(out_dir)
+                if is_good:
+                    logger.info("finished %s in %s" % (
+                        datafile.get_base(out_dir), format_time(c)))
+                else:
+                    logger.error("failed: " + datafile.get_base(out_dir))
+                finish((options, c, is_good))
 
-            params = {
-              '-d': fname,
-              '-o': out_dir
-            }
-            params.update(options)
-            run(params)
+    except KeyboardInterrupt:
+        for options, process, start_time in running_jobs:
+            process.terminate()
+        raise
 
-            if not is_good_morpheus_output(out_dir):
-                raise Exception
+    return timings
 
-            end = time.time()
-            c = end - start
 
-            hours = c // 3600 % 24
-            minutes = c // 60 % 60
-            seconds = c % 60
+# seconds that the size and mtime of a data file must be unchanged
+# before it is searched, so that RAW files still being acquired or
+# copied are not searched
+default_settle_time = 300
 
-            logger.info("finished in %d:%02d:%04.1f" % (hours, minutes, seconds))
+# seconds that batch waits for settling files before leaving them to
+# the next batch
+default_max_settle_wait = 900
 
-        except KeyboardInterrupt:
-            raise
-        except:
-            logger.error("failed: " + datafile.get_base(out_dir))
 
+# options that don't change the results of a search
+UNKEYED_OPTIONS = ['-d', '-o', '-mt']
+
+
+def load_result_cache(cache_json):
+    if os.path.isfile(cache_json):
+        try:
+            return datafile.load_json(cache_json)
+        except ValueError:
+            logger.error("Ignoring corrupt " + cache_json)
+    return {'file_hashes': {}, 'results': {}, 'out_dirs': {}}
+
+
+def get_cached_file_hash(fname, cache):
+    """
+    Returns the content hash of fname, only re-reading the file if its
+    size or mtime differs from the last time it was hashed.
+    """
+    path = os.path.abspath(fname)
+    stat = os.stat(fname)
+    entry = cache['file_hashes'].get(path)
+    if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+        return entry[2]
+    file_hash = datafile.get_file_hash(fname)
+    cache['file_hashes'][path] = [stat.st_size, stat.st_mtime, file_hash]
+    return file_hash
+
+
+morpheus_hashes = {}
+
+
+def get_morpheus_hash(is_thermo=False):
+    """
+    Returns a hash of the Morpheus binary and its tsv files.
+    """
+    morpheus_dir = get_staged_morpheus_dir(is_thermo)
+    if morpheus_dir not in morpheus_hashes:
+        hasher = hashlib.sha1()
+        fnames = [get_morpheus_exe(is_thermo, morpheus_dir)]
+        for fname in sorted(os.listdir(morpheus_dir)):
+            if fname.endswith('.tsv'):
+                fnames.append(os.path.join(morpheus_dir, fname))
+        for fname in fnames:
+            hasher.update(datafile.get_file_hash(fname).encode('utf-8'))
+        morpheus_hashes[morpheus_dir] = hasher.hexdigest()
+    return morpheus_hashes[morpheus_dir]
+
+
+def get_search_key(options, cache):
+    """
+    Returns a key that identifies the results of a search by the
+    contents of the data file, the database and the Morpheus binary,
+    and the options, but not by their file names.
+    """
+    key_options = {}
+    for key, val in options.items():
+        if key not in UNKEYED_OPTIONS:
+            key_options[key] = str(val).strip()
+    if '-db' in key_options:
+        key_options['-db'] = get_cached_file_hash(options['-db'], cache)
+    key = [
+        get_cached_file_hash(options['-d'], cache),
+        get_morpheus_hash(is_thermo_options(options)),
+        key_options,
+    ]
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def lock_result_cache(cache_json):
+    """
+    Returns a lock on the result cache, under which it is loaded,
+    changed and saved, as overlapping batches and run_queue change it.
+    """
+    dirname = os.path.dirname(os.path.abspath(cache_json))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return datafile.lock_dir(
+        dirname, '.' + os.path.basename(cache_json) + '.lock')
+
+
+def record_result(cache_json, out_dir, key):
+    with lock_result_cache(cache_json):
+        cache = load_result_cache(cache_json)
+        rel_out_dir = os.path.relpath(out_dir, os.path.dirname(cache_json))
+        cache['out_dirs'][rel_out_dir] = key
+        cache['results'][key] = rel_out_dir
+        datafile.write_json(cache, cache_json)
+
+
+def run_queue(
+        queue_json, n_job=1, n_thread=None, instruments=None,
+        is_fresh_only=False):
+    """
+    Runs the searches in the jobqueue.JobQueue in queue_json, most
+    urgent first, and records the good results in the result cache of
+    each search (see batch) as they finish. If instruments are given,
+    only their searches are run, and with is_fresh_only, only fresh
+    searches, leaving the backfill to another run.
+
+    At most n_job searches run at a time. With n_job >= 2, backfill
+    takes at most n_job - 1 of them, keeping one for fresh runs. With
+    n_job = 1, a fresh run waits for a running backfill search.
+    """
+    queue = jobqueue.JobQueue(queue_json)
+    n_job = max(1, n_job)
+    n_backfill_job = n_job - 1 if n_job >= 2 else 1
+    if is_fresh_only:
+        n_backfill_job = 0
+    entry_by_out_dir = {}
+
+    def pop_job():
+        entry = queue.pop(n_job, n_backfill_job, instruments)
+        if entry is None:
+            return None
+        entry_by_out_dir[entry['options']['-o']] = entry
+        return entry['options']
+
+    def finish_job(options, c, is_good):
+        entry = entry_by_out_dir.pop(options['-o'])
+        if is_good:
+            record_result(entry['cache_json'], options['-o'], entry['key'])
+        queue.finish(options['-o'])
+
+    return run_jobs(pop_job, n_job, n_thread, finish_fn=finish_job)
+
+
+def batch(
+        fnames, out_dir_fn, options={'-ad':'true','-mmu':'true'},
+        dummy=False, n_job=1, n_thread=None, cache_json=None,
+        settle_time=None, max_settle_wait=None, queue_json=None,
+        is_run=True, settled_fnames=[]):
+    """
+    Searches fnames with Morpheus, into out_dir_fn(fname). Up to n_job
+    searches are run concurrently, see run_jobs.
+
+    Results are recorded in cache_json (default: morpheus.results.json
+    next to the first output directory) by a hash of the data file,
+    database, Morpheus binary and options. A search is skipped if its
+    output directory has good output for the same key, or if the same
+    search, e.g. of a renamed data file, has good output in another
+    directory, which is then copied. Output of an older search with
+    different options is re-searched.
+
+    Data files are only searched once they have settled, i.e. have been
+    seen with the same size and mtime settle_time seconds apart, so
+    that files still being written or copied are not searched, see
+    datafile.SettlingFiles. Until then they are left pending (in the
+    cache, so that later batches retry them), and are retried after
+    the other searches, for up to max_settle_wait seconds. Files in
+    settled_fnames, which the caller has already seen settle, e.g.
+    watch_qc.py, are searched without waiting.
+
+    The searches are queued in the jobqueue.JobQueue in queue_json
+    (default: morpheus.queue.json next to cache_json), which runs fresh
+    QC runs before backfill, and run with run_queue. With is_run False,
+    they are only queued, e.g. to queue several batches before running
+    them all with run_queue.
+    """
+    if settle_time is None:
+        settle_time = default_settle_time
+    if max_settle_wait is None:
+        max_settle_wait = default_max_settle_wait
+
+    fnames = [f for f in fnames if datafile.get_date_from_fname(f)]
+    if not fnames:
+        return []
+    if cache_json is None:
+        cache_json = os.path.join(
+            os.path.dirname(os.path.abspath(out_dir_fn(fnames[0]))),
+            'morpheus.results.json')
+    cache_dir = os.path.dirname(os.path.abspath(cache_json))
+    if queue_json is None:
+        queue_json = os.path.join(cache_dir, 'morpheus.queue.json')
+    queue = jobqueue.JobQueue(queue_json)
+    settled_paths = set(os.path.abspath(f) for f in settled_fnames)
+
+    timings = []
+    start_time = time.time()
+    while True:
+        jobs = []
+        out_dirs = []
+        pending_fnames = []
+        running_out_dirs = queue.get_running_out_dirs()
+        # reloaded every round and changed under the lock, as run_queue,
+        # here or in an overlapping process, records results in it
+        with lock_result_cache(cache_json):
+            cache = load_result_cache(cache_json)
+            settling = datafile.SettlingFiles(
+                settle_time, cache.setdefault('settling', {}))
+            for fname in fnames:
+                out_dir = out_dir_fn(fname)
+                rel_out_dir = os.path.relpath(out_dir, cache_dir)
+
+                if os.path.abspath(out_dir) in running_out_dirs:
+                    logger.debug(
+                        "Already searching " + datafile.get_base(out_dir))
+                    continue
+
+                path = os.path.abspath(fname)
+                if path not in settled_paths \
+                        and not settling.is_settled(path):
+                    if path in settling.state:
+                        logger.info("Waiting for %s to settle" %
+                            datafile.get_base(fname))
+                        pending_fnames.append(fname)
+                    continue
+
+                params = {
+                  '-d': fname,
+                  '-o': out_dir
+                }
+                params.update(options)
+                try:
+                    key = get_search_key(params, cache)
+                except (IOError, OSError) as e:
+                    logger.error(
+                        "failed: %s: %s" % (datafile.get_base(fname), e))
+                    continue
+                out_dirs.append(out_dir)
+
+                if os.path.isdir(out_dir) and is_good_morpheus_output(out_dir):
+                    prev_key = cache['out_dirs'].get(rel_out_dir)
+                    if prev_key is None or prev_key == key:
+                        # output from before the cache is trusted
+                        logger.debug("Skipping " + datafile.get_base(out_dir))
+                        cache['out_dirs'][rel_out_dir] = key
+                        cache['results'][key] = rel_out_dir
+                        continue
+                    logger.info(
+                        "Options changed for " + datafile.get_base(out_dir))
+                else:
+                    rel_cached_dir = cache['results'].get(key)
+                    if rel_cached_dir and rel_cached_dir != rel_out_dir:
+                        cached_dir = os.path.join(cache_dir, rel_cached_dir)
+                        if os.path.isdir(cached_dir) \
+                                and is_good_morpheus_output(cached_dir):
+                            logger.info("Copying identical search %s to %s" % (
+                                datafile.get_base(cached_dir),
+                                datafile.get_base(out_dir)))
+                            if not dummy:
+                                if os.path.isdir(out_dir):
+                                    shutil.rmtree(out_dir)
+                                shutil.copytree(cached_dir, out_dir)
+                                cache['out_dirs'][rel_out_dir] = key
+                            continue
+
+                jobs.append((params, key, cache_json))
+
+            if not dummy:
+                settling.prune()
+                datafile.write_json(cache, cache_json)
+
+        if dummy:
+            break
+        queue.update(jobs, out_dirs)
+        if not is_run:
+            break
+        timings.extend(run_queue(queue_json, n_job, n_thread))
+
+        if not pending_fnames:
+            break
+        wait = max_settle_wait - (time.time() - start_time)
+        if wait <= 0:
+            logger.info(
+                "%d files still settling, leaving them for the next batch" %
+                len(pending_fnames))
+            break
+        if not jobs:
+            time.sleep(max(1, min(settle_time, wait)))
+        fnames = pending_fnames
+
+    return timings
 
 
 if __name__ == "__main__":
@@ -17,6 +17,9 @@ log/msms.json.
 
 import os
 import glob
+import math
+import heapq
+import operator
 import logging
 
 import datafile
@@ -36,79 +39,147 @@ def print_pep(pep):
          pep['sequence']))
 
 
-def get_peptide_by_seq(fnames):
-    times = []
+def add_psm_file(aggregate_by_seq, fname):
+    """
+    Adds the PSMs in fname to the running aggregates, per peptide
+    sequence, of the counts, sums and sums of squares of the
+    fraction-of-ion-products and ms-intensities.
+    """
+    date = datafile.get_date_from_fname(fname)
+
+    logger.debug("Reading peptides in %s" % date)
+    seqs = set()
+    columns = [
+        'Peptide Sequence',
+        'Base Peptide Sequence',
+        'Fraction of Intensity Matching',
+        'Ratio of Matching Products']
+    for seq, base_seq, intensity, ion in \
+            datafile.iter_csv_columns(fname, columns):
+        if seq not in aggregate_by_seq:
+            aggregate_by_seq[seq] = {
+                'sequence': seq,
+                'base_sequence': base_seq,
+                'n_log': 0,
+                'n_psm': 0,
+                'intensity_sum': 0.0,
+                'intensity_sum_sq': 0.0,
+                'ion_sum': 0.0,
+                'ion_sum_sq': 0.0,
+            }
+        aggregate = aggregate_by_seq[seq]
+        intensity = float(intensity)
+        ion = float(ion)
+        aggregate['n_psm'] += 1
+        aggregate['intensity_sum'] += intensity
+        aggregate['intensity_sum_sq'] += intensity*intensity
+        aggregate['ion_sum'] += ion
+        aggregate['ion_sum_sq'] += ion*ion
+        seqs.add(seq)
+
+    for seq in seqs:
+        aggregate_by_seq[seq]['n_log'] += 1
+
+
+def get_avg_std_from_sums(n, value_sum, value_sum_sq):
+    avg = value_sum / float(n)
+    var = max(0.0, value_sum_sq / float(n) - avg*avg)
+    return avg, math.sqrt(var)
+
+
+def get_peptide_by_seq_from_aggregates(aggregate_by_seq):
     peptide_by_seq = {}
-    for fname in fnames:
-        date = datafile.get_date_from_fname(fname)
-
-        logger.debug("Reading peptides in %s" % date)
-        seqs = []
-        for entry in datafile.read_csv(fname):
-            seq = entry['Peptide Sequence']
-            if seq not in peptide_by_seq:
-                peptide_by_seq[seq] = {
-                    'sequence': seq,
-                    'base_sequence': entry['Base Peptide Sequence'],
-                    'intensity_fractions': [],
-                    'ion_fractions': [],
-                    'n_log': 0
-                }
-            peptide = peptide_by_seq[seq]
-            peptide['intensity_fractions'].append(
-                float(entry['Fraction of Intensity Matching']))
-            peptide['ion_fractions'].append(
-                float(entry['Ratio of Matching Products']))
-            seqs.append(seq)
-
-        for seq in set(seqs):
-            peptide_by_seq[seq]['n_log'] += 1
-
-    for peptide in peptide_by_seq.values():
-        ion_avg, ion_stdv = datafile.get_avg_std(peptide['ion_fractions'])
-        intensity_avg, intensity_stdv = datafile.get_avg_std(
-            peptide['intensity_fractions'])
-        peptide.update({
+    for seq, aggregate in aggregate_by_seq.items():
+        n = aggregate['n_psm']
+        ion_avg, ion_stdv = get_avg_std_from_sums(
+            n, aggregate['ion_sum'], aggregate['ion_sum_sq'])
+        intensity_avg, intensity_stdv = get_avg_std_from_sums(
+            n, aggregate['intensity_sum'], aggregate['intensity_sum_sq'])
+        peptide_by_seq[seq] = {
+            'sequence': aggregate['sequence'],
+            'base_sequence': aggregate['base_sequence'],
+            'n_log': aggregate['n_log'],
+            'n_psm': n,
             'ion_avg': ion_avg,
             'ion_stdv': ion_stdv,
             'intensity_avg': intensity_avg,
             'intensity_stdv': intensity_stdv,
-            'n_psm': len(peptide['intensity_fractions']),
-        })
-
+        }
     return peptide_by_seq
 
 
-def extract_top_peptides(peptide_by_seq, n):
-    peptides = peptide_by_seq.values()
-    peptides.sort(key=lambda p: p['intensity_avg'], reverse=True)
-    peptides.sort(key=lambda p: p['n_log'], reverse=True)
+def get_peptide_by_seq(fnames):
+    aggregate_by_seq = {}
+    for fname in fnames:
+        add_psm_file(aggregate_by_seq, fname)
+    return get_peptide_by_seq_from_aggregates(aggregate_by_seq)
+
+
+def select_top_peptides(peptides, n, key, is_selected=None):
+    """
+    Returns the n peptides with the largest key, in descending order,
+    of those for which is_selected(peptide) is true, without sorting
+    all peptides. key is a function of a peptide, or the name or a
+    list of names of the fields to compare, e.g. 'n_psm' or
+    ['n_log', 'intensity_avg']. Ties keep the order of peptides.
+    """
+    if isinstance(key, basestring):
+        key = operator.itemgetter(key)
+    elif not callable(key):
+        key = operator.itemgetter(*key)
+    if is_selected is not None:
+        peptides = (p for p in peptides if is_selected(p))
+    return heapq.nlargest(n, peptides, key=key)
+
+
+def extract_top_peptides(peptide_by_seq, n, min_intensity=0.1):
+    peptides = select_top_peptides(
+        peptide_by_seq.values(),
+        n,
+        ['n_log', 'intensity_avg'],
+        # for some entries with 0 intensities
+        lambda p: p['intensity_avg'] >= min_intensity)
     top_peptides = {}
     for peptide in peptides:
-        if peptide['intensity_avg'] < 0.1:
-            # for some entries with 0 intensities
-            continue
         print_pep(peptide)
         top_peptides[peptide['sequence']] = peptide
-        if len(top_peptides) >= n:
-            break
     return top_peptides
 
 
 def find_top_peptides(psm_fnames, out_base, n_peptide):
+    """
+    Writes the top n_peptide peptides of psm_fnames to out_base.json.
+
+    The per-sequence aggregates are kept in out_base.aggregates.json,
+    so only PSM files not seen before are read. If a file has been
+    removed from psm_fnames, the aggregates are rebuilt.
+    """
     psm_fnames_json = out_base + '.fnames.json'
-    if os.path.isfile(psm_fnames_json):
-        prev_psm_fnames = datafile.load_json(psm_fnames_json)
-    else:
-        datafile.write_json(psm_fnames, psm_fnames_json)
-        prev_psm_fnames = []
+    aggregates_json = out_base + '.aggregates.json'
+    top_peptides_json = out_base + '.json'
 
-    if psm_fnames == prev_psm_fnames:
-        return
+    if os.path.isfile(aggregates_json):
+        aggregates = datafile.load_json(aggregates_json)
+    else:
+        aggregates = {'fnames': [], 'aggregate_by_seq': {}}
 
-    peptide_by_seq = get_peptide_by_seq(psm_fnames)
-    top_peptides = extract_top_peptides(peptide_by_seq, n_peptide)
-    datafile.write_json(top_peptides, out_base + '.json')
+    prev_psm_fnames = set(aggregates['fnames'])
+    if not prev_psm_fnames.issubset(psm_fnames):
+        logger.debug("PSM files removed, rebuilding peptide aggregates")
+        aggregates = {'fnames': [], 'aggregate_by_seq': {}}
+        prev_psm_fnames = set()
 
+    new_psm_fnames = [f for f in psm_fnames if f not in prev_psm_fnames]
+    if not new_psm_fnames and os.path.isfile(top_peptides_json):
+        return
 
+    for fname in new_psm_fnames:
+        add_psm_file(aggregates['aggregate_by_seq'], fname)
+    aggregates['fnames'].extend(new_psm_fnames)
+    datafile.write_json(aggregates, aggregates_json)
+    datafile.write_json(aggregates['fnames'], psm_fnames_json)
 
+    peptide_by_seq = get_peptide_by_seq_from_aggregates(
+        aggregates['aggregate_by_seq'])
+    top_peptides = extract_top_peptides(peptide_by_seq, n_peptide)
+    datafile.write_json(top_peptides, top_peptides_json)
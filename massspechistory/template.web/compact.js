@@ -0,0 +1,49 @@
+// Decodes the compact chart payload written by chart.encode_charts
+// in python back into the list of charts drawn by the templates.
+// Payloads that are already a list of charts are returned as is.
+
+function decode_base64_array(text, ArrayType) {
+    var binary = atob(text);
+    var bytes = new Uint8Array(binary.length);
+    for (var i = 0; i < binary.length; i += 1) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return new ArrayType(bytes.buffer);
+}
+
+function decode_charts(data) {
+    if (data.encoding != 'compact') {
+        return data;
+    }
+
+    var deltas = decode_base64_array(data.x, Float64Array);
+    var xs = [];
+    var x = 0;
+    for (var i = 0; i < deltas.length; i += 1) {
+        x += deltas[i];
+        xs.push(x);
+    }
+
+    var charts = [];
+    for (var i_chart = 0; i_chart < data.charts.length; i_chart += 1) {
+        var compact_chart = data.charts[i_chart];
+        var chart_data = [];
+        for (var j = 0; j < compact_chart.chart_data.length; j += 1) {
+            var series = compact_chart.chart_data[j];
+            var ys = decode_base64_array(series.y, Float32Array);
+            var values = [];
+            for (var i = 0; i < ys.length; i += 1) {
+                if (!isNaN(ys[i])) {
+                    values.push([xs[i], ys[i]]);
+                }
+            }
+            chart_data.push({ key: series.key, values: values });
+        }
+        charts.push({
+            title: compact_chart.title,
+            description: compact_chart.description,
+            chart_data: chart_data
+        });
+    }
+    return charts;
+}
@@ -1,25 +1,48 @@
 import os
+import sys
 import glob
 import re
 from datetime import datetime
 import logging
 
-from massspechistory import datafile, morpheus
+from massspechistory import datafile, morpheus, fileindex
 
 """
 Finds Thermo .raw files and automatically runs a Morpheus MS/MS
 search against either an E. Coli or Human database.
+
+Usage: python process_raw_files.py [instrument ...] [-new fname ...]
+
+With -new, the .raw files given have just landed and settled, as seen
+by watch_qc.py, and are searched without waiting for them to settle.
+Only the fresh searches of the instruments are then run, leaving the
+backfill in the queue to the cron job.
 """
 
 logger = logging.getLogger('process_raw_files')
 
+# number of Morpheus searches to run at the same time
+n_morpheus_job = 2
+
+# the searches of all instruments and digests share a queue, which
+# runs the most recent QC runs first, and older runs after them
+queue_json = os.path.join('..', 'morpheus.queue.json')
+queue_log = os.path.join('..', 'morpheus.queue.log')
+
+
+args = sys.argv[1:]
+new_fnames = []
+if '-new' in args:
+    new_fnames = args[args.index('-new') + 1:]
+    args = args[:args.index('-new')]
+instruments = args
+
 
-<<<<<<< HEAD
-for instrument in ['qeclassic', 'qeplus', 'qeplus2']:
-=======
 for instrument in open('instruments.txt', 'Ur').read().split():
->>>>>>> abe455450250ca58d3b4fe7650581a92b28bc90f
-    raw_files_dir = os.path.join('..', instrument, "instrument_data")
+    # only the instruments given on the command line, if any
+    if instruments and instrument not in instruments:
+        continue
+
     results_dir = os.path.join('..', instrument)
     web_dir = os.path.join('..', instrument, 'web')
     if not os.path.isdir(web_dir):
@@ -34,17 +57,23 @@ for instrument in open('instruments.txt', 'Ur').read().split():
 
     logger.info('Checking raw files on %s' % instrument)
 
-    for morpheus_dir, regex, db in [
-            ('hela_morpheus', r"\b(Hela|hela).*\d{12}", "db/HUMAN.fasta"),
-            ('ecoli_morpheus', r"\b(E|e)coli.*\d{12}", "db/E_coli_uniprot_iRT.fasta"), 
+    # one scan of the instrument directory for both digests, only
+    # listing the directories that changed since the last run
+    files = fileindex.FileIndex(
+        results_dir,
+        os.path.join(web_dir, 'files.index.json'),
+        skip_dirs=[web_dir]).scan()
+
+    for morpheus_dir, digest, db in [
+            ('hela_morpheus', 'hela', "db/HUMAN.fasta"),
+            ('ecoli_morpheus', 'ecoli', "db/E_coli_uniprot_iRT.fasta"), 
         ]:
 
         out_dir = os.path.join(results_dir, morpheus_dir)
         out_dir_fn = lambda f: os.path.join(out_dir, datafile.get_base(f))
 
-        raw_files =  datafile.glob_re(
-            os.path.join(raw_files_dir, "*.raw"),
-            regex)
+        raw_files = files.find(
+            'instrument_data/*.raw', digest=digest, is_dated=True)
 
         raw_files = [f for f in raw_files if 'corrupt' not in f.lower()]
         morpheus.batch(
@@ -64,8 +93,24 @@ for instrument in open('instruments.txt', 'Ur').read().split():
                 '-vm': 'Ox',
                 '-fm': 'AlkC',
                 '-acs': 'false'
-            }
+            },
+            queue_json=queue_json,
+            is_run=False,
+            settled_fnames=new_fnames,
         )
 
     root = logging.getLogger()
     map(root.removeHandler, root.handlers[:])
+
+
+logging.basicConfig(
+    level=logging.INFO, 
+    filename=queue_log,
+    format='%(asctime)s|%(name)s|%(levelname)s|%(message)s',
+    datefmt='%Y-%m-%d|%H:%M:%S')
+
+morpheus.run_queue(
+    queue_json, 
+    n_job=n_morpheus_job,
+    instruments=instruments or None,
+    is_fresh_only=bool(new_fnames))
@@ -8,6 +8,7 @@ import platform
 from massspechistory import chart
 from massspechistory import datafile
 from massspechistory import outliers
+from massspechistory import fileindex
 
 
 
@@ -22,80 +23,106 @@ recipients = [
 
 logger = logging.getLogger('update_website')
 
+# write the chart payloads with chart.encode_charts, a shared time axis
+# and base64 typed arrays instead of [x, y] pairs for every series
+is_compact_charts = True
 
-def make_chart_data(data_dir, website_dir, title, description):
+# downsample charts with more points than this for the overview,
+# None to always send every point
+max_chart_point = 2000
+
+
+def write_charts(payloads, group, logs, definitions):
+    """
+    Draws the charts of group from logs, one per definition of
+    [params, title(, description)] as for chart.make_chart, with their
+    daily, weekly and monthly rollups, kept in <group>.rollups.json.
+    """
+    columns = chart.LogColumns(logs)
+    rollups = chart.update_rollups(
+        logs, os.path.join(payloads.website_dir, group + '.rollups.json'))
+    charts = []
+    rollup_charts = []
+    for definition in definitions:
+        charts.append(chart.make_chart(columns, *definition))
+        rollup_charts.append(chart.make_rollup_charts(rollups, *definition))
+    payloads.write_charts(group, charts, rollup_charts)
+
+
+def make_chart_data(
+        data_dir, website_dir, title, description, is_compact=False,
+        max_point=None):
     if not os.path.isdir(website_dir):
         os.makedirs(website_dir)
-    datafile.copy_dir('massspechistory/template.web', website_dir)
+    datafile.copy_dir(
+        'massspechistory/template.web', website_dir, is_sync=True)
 
-    charts = []
+    # charts are only redrawn if their logs have changed
+    payloads = chart.ChartPayloads(website_dir, is_compact, max_point)
+
+    # one scan of data_dir for the summaries, PSMs and iRT reports
+    files = fileindex.FileIndex(
+        data_dir,
+        os.path.join(website_dir, 'files.index.json'),
+        skip_dirs=[website_dir]).scan()
 
 
     morpheus_yaml = os.path.join(website_dir, 'msms.logs.yaml')
     logs = chart.parse_logs(
-        glob.glob(
-            os.path.join(data_dir, '*_morpheus/*/summary.tsv')),
+        files.find('*_morpheus/*/summary.tsv'),
         chart.parse_morpheus_summary, 
         morpheus_yaml)
-
-    charts.append(chart.make_chart(
-        logs, 
-        [['Ecoli Spectra', ['Ecoli MS/MS Spectra']],
-         ['Hela Spectra', ['Hela MS/MS Spectra']]], 
-        'Digest MS/MS Spectra'))
-    charts.append(chart.make_chart(
-        logs, 
-        [['Ecoli PSM', ['Ecoli Target PSMs']],
-         ['Hela PSM', ['Hela Target PSMs']]], 
-        'Digest Peptide-Spectrum Matches'))
-    charts.append(chart.make_chart(
-        logs, 
-        [['Ecoli Peptides', ['Ecoli Unique Target Peptides']],
-         ['Hela Peptides', ['Hela Unique Target Peptides']]], 
-        'Digest Unique Peptides'))
-    charts.append(chart.make_chart(
-        logs, 
-        [['Ecoli Proteins', ['Ecoli Target Protein Groups']],
-         ['Hela Proteins', ['Hela Target Protein Groups']]], 
-        'Digest Protein Groups'))
+    definitions = [
+        [[['Ecoli Spectra', ['Ecoli MS/MS Spectra']],
+          ['Hela Spectra', ['Hela MS/MS Spectra']]], 
+         'Digest MS/MS Spectra'],
+        [[['Ecoli PSM', ['Ecoli Target PSMs']],
+          ['Hela PSM', ['Hela Target PSMs']]], 
+         'Digest Peptide-Spectrum Matches'],
+        [[['Ecoli Peptides', ['Ecoli Unique Target Peptides']],
+          ['Hela Peptides', ['Hela Unique Target Peptides']]], 
+         'Digest Unique Peptides'],
+        [[['Ecoli Proteins', ['Ecoli Target Protein Groups']],
+          ['Hela Proteins', ['Hela Target Protein Groups']]], 
+         'Digest Protein Groups'],
+    ]
+    if payloads.is_changed('msms', logs, definitions):
+        write_charts(payloads, 'msms', logs, definitions)
 
 
     morpheus_yaml = os.path.join(website_dir, 'psm.logs.yaml')
     logs = chart.parse_logs(
-        glob.glob(
-            os.path.join(data_dir, '*_morpheus/*/*PSMs.tsv')),
+        files.find('*_morpheus/*/*PSMs.tsv'),
         chart.parse_morpheus_psm, 
         morpheus_yaml)
-    charts.append(chart.make_chart(
-        logs, 
-        [['Ecoli dMass avg', ['Ecoli Precursor Mass Error (ppm)']],
-         ['Ecoli dMass avg+std', ['Ecoli Precursor Mass Error (ppm) Upper']],
-         ['Hela dMass avg', ['Hela Precursor Mass Error (ppm)']], 
-         ['Hela dMass avg+std', ['Hela Precursor Mass Error (ppm) Upper']]], 
-        'Digest Precursor dMass [ppm]'))
+    definitions = [
+        [[['Ecoli dMass avg', ['Ecoli Precursor Mass Error (ppm)']],
+          ['Ecoli dMass avg+std', ['Ecoli Precursor Mass Error (ppm) Upper']],
+          ['Hela dMass avg', ['Hela Precursor Mass Error (ppm)']], 
+          ['Hela dMass avg+std', ['Hela Precursor Mass Error (ppm) Upper']]], 
+         'Digest Precursor dMass [ppm]'],
+    ]
+    if payloads.is_changed('psm', logs, definitions):
+        write_charts(payloads, 'psm', logs, definitions)
 
 
     logs = chart.parse_logs(
-        datafile.glob_re(
-            os.path.join(data_dir, 'instrument_data', '*.txt'), 
-            r'(Hela|hela|ecoli).*iRT'),
+        files.find('instrument_data/*.txt', kind='irt'),
         chart.parse_irt_log, 
         os.path.join(website_dir, 'irt_peptides.logs.yaml'))
+    definitions = []
     if len(logs) > 0:
-#        print logs[0].keys()
+#            print logs[0].keys()
         pep_ids = logs[0]['peptides'].keys()
-        charts.append(chart.make_chart(
-            logs, 
+        definitions.append([
             chart.make_pep_id_params(pep_ids, 'RT'), 
             'iRT Peptides Retention Time',
-            'The measured retention time of the peptides'))
-        charts.append(chart.make_chart(
-            logs, 
+            'The measured retention time of the peptides'])
+        definitions.append([
             chart.make_pep_id_params(pep_ids, 'Height'), 
             'iRT Peptides Peak Height', 
-            'Height of the peak associated at the retention time'))
-        charts.append(chart.make_chart(
-            logs,
+            'Height of the peak associated at the retention time'])
+        definitions.append([
             [['Symmetry',['irt_summ','S']],
             ['Resolution',['irt_summ','R']],
             ['Peak Width',['irt_summ','W']],
@@ -106,14 +133,13 @@ def make_chart_data(data_dir, website_dir, title, description):
             ['Concave',['irt_summ','C']],
             ['Saturation',['irt_summ','D']]],
             'System suitability flags',
-            'Number of iRT peptides failing given suitability test'))
-#        for log in logs[0:1]:
-#            print log['peptides']
+            'Number of iRT peptides failing given suitability test'])
+#            for log in logs[0:1]:
+#                print log['peptides']
+    if payloads.is_changed('irt_peptides', logs, definitions):
+        write_charts(payloads, 'irt_peptides', logs, definitions)
 
-    datafile.write_jsonp(
-        charts, 
-        os.path.join(website_dir, 'load_charts.jsonp'),
-        'load_charts')
+    payloads.write_manifest()
 
     datafile.write_jsonp(
         { 'title': title, 'description': description },
@@ -122,20 +148,15 @@ def make_chart_data(data_dir, website_dir, title, description):
 
 
 def check_timepoints_for_outliers(website_dir, instrument, recipients=[]):
-<<<<<<< HEAD
     if platform.system() == 'Windows':
         return
-=======
-#    if platform.system() == 'Windows':
-#        return
->>>>>>> abe455450250ca58d3b4fe7650581a92b28bc90f
 
     timepoints_yaml = os.path.join(website_dir, 'timepoints.yaml')
     timepoints = datafile.load_cache_yaml(timepoints_yaml)
 
     # Calculate limits for all variables
     limit = {}
-    logs = datafile.load_yaml(
+    logs = chart.load_logs(
         os.path.join(website_dir, 'msms.logs.yaml'))
     params_list = [
         ['Hela MS/MS Spectra'], 
@@ -151,7 +172,7 @@ def check_timepoints_for_outliers(website_dir, instrument, recipients=[]):
         outliers.set_lower_limit_of_param(
             limit, params, params[0], logs, timepoints)
 
-    logs = datafile.load_yaml(
+    logs = chart.load_logs(
         os.path.join(website_dir, 'irt_peptides.logs.yaml'))
     if len(logs) > 0:
         pep_ids = logs[0]['peptides'].keys()
@@ -167,11 +188,6 @@ def check_timepoints_for_outliers(website_dir, instrument, recipients=[]):
             continue
         bad_params = [p for p in time_point if not time_point[p]]
         bad_pep_params = [p for p in bad_params if p.startswith("pep")]
-<<<<<<< HEAD
-=======
-        print time,bad_params
-        print time,bad_pep_params
->>>>>>> abe455450250ca58d3b4fe7650581a92b28bc90f
         if len(bad_pep_params) <= 3:
             # if only 3 or less irt peptides are bad,
             # consider okay and remove from bad_params
@@ -184,37 +200,15 @@ def check_timepoints_for_outliers(website_dir, instrument, recipients=[]):
     if bad_times:
         message = outliers.bad_times_message(
             instrument, bad_times, timepoints, limit)
-<<<<<<< HEAD
         outliers.report_by_email(
             instrument, message, recipients)
-=======
-        print message
-#        outliers.report_by_email(
-#            instrument, message, recipients)
->>>>>>> abe455450250ca58d3b4fe7650581a92b28bc90f
 
-    datafile.write_yaml(timepoints, timepoints_yaml)
+    datafile.write_cache(timepoints, timepoints_yaml)
 
 
 
 # Main Loop
 
-<<<<<<< HEAD
-for instrument, description in [
-        ('qeclassic', 'Monash Proteomics Facility. Thermo QExactive'),
-        ('qeplus', 'Monash Proteomics Facility. Thermo QExactive Plus'),
-        ('qeplus2', 'Monash Proteomics Facility. Thermo QExactive Plus'),
-        ]:
-    data_dir = "../" + instrument
-    web_dir = "../%s/web" % instrument
-    log = "../%s/web/run.log" % instrument
-    recipients = [
-        'apposite@gmail.com', 
-        'oded.kleifeld@monash.edu', 
-        'robert.goode@monash.edu', 
-        'david.steer@monash.edu',
-   ]
-=======
 # automatically any directories that has instrument_data for processing
 for instrument in open('instruments.txt', 'Ur').read().split():
 
@@ -226,7 +220,10 @@ for instrument in open('instruments.txt', 'Ur').read().split():
     data_dir = "../" + instrument
     web_dir = "../%s/web" % instrument
     log = "../%s/web/run.log" % instrument
->>>>>>> abe455450250ca58d3b4fe7650581a92b28bc90f
+
+    # only the instruments given on the command line, if any
+    if sys.argv[1:] and instrument not in sys.argv[1:]:
+        continue
 
     if not os.path.isdir(web_dir):
         os.makedirs(web_dir)
@@ -242,7 +239,9 @@ for instrument in open('instruments.txt', 'Ur').read().split():
 
     logger.info("Making chart data for " + instrument)
 
-    make_chart_data(data_dir, web_dir, instrument, description)
+    make_chart_data(
+        data_dir, web_dir, instrument, description, is_compact_charts,
+        max_chart_point)
     check_timepoints_for_outliers(web_dir, instrument, recipients)
 
     root = logging.getLogger()
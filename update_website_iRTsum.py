@@ -131,7 +131,7 @@ def check_timepoints_for_outliers(website_dir, instrument, recipients=[]):
 
     # Calculate limits for all variables
     limit = {}
-    logs = datafile.load_yaml(
+    logs = datafile.load_cache(
         os.path.join(website_dir, 'msms.logs.yaml'))
     params_list = [
         ['Hela MS/MS Spectra'], 
@@ -147,7 +147,7 @@ def check_timepoints_for_outliers(website_dir, instrument, recipients=[]):
         outliers.set_lower_limit_of_param(
             limit, params, params[0], logs, timepoints)
 
-    logs = datafile.load_yaml(
+    logs = datafile.load_cache(
         os.path.join(website_dir, 'irt_peptides.logs.yaml'))
     if len(logs) > 0:
         pep_ids = logs[0]['peptides'].keys()
@@ -181,7 +181,7 @@ def check_timepoints_for_outliers(website_dir, instrument, recipients=[]):
 #        outliers.report_by_email(
 #            instrument, message, recipients)
 
-    datafile.write_yaml(timepoints, timepoints_yaml)
+    datafile.write_cache(timepoints, timepoints_yaml)
 
 
 
@@ -0,0 +1,179 @@
+import os
+import sys
+import time
+import logging
+import subprocess
+import Queue
+
+from massspechistory import datafile, fileindex, morpheus
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+"""
+Watches the instrument_data directory of each instrument and, once a
+new .raw file or iRT report has stopped growing, runs
+process_raw_files.py and update_website.py for that instrument, so
+that QC failures are reported minutes after a run finishes instead of
+at the next cron job. process_raw_files.py is given the new .raw
+files with -new, so that only the fresh searches of the instrument
+are run, and not the backfill of the queue shared with the cron job.
+Both scripts are incremental, so only the new file is searched and
+parsed, and only its charts are redrawn.
+
+File events come from watchdog (inotify on Linux) if it is installed,
+otherwise, or with -poll for Samba mounts where inotify doesn't see
+remote writes, the directories are polled with fileindex.
+
+Usage: python watch_qc.py [-poll] [instrument ...]
+"""
+
+logger = logging.getLogger('watch_qc')
+
+# seconds that the size and mtime of a new file must stay the same
+# before it is processed, as in morpheus.batch
+settle_time = morpheus.default_settle_time
+
+# seconds between checks of the settling files, and between scans
+# when polling
+poll_interval = 30
+
+# kinds of files, see fileindex.kind_patterns, that trigger a run
+watched_kinds = ['raw', 'irt']
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_watched_kind(fname):
+    fname = fname.replace('\\', '/')
+    if 'corrupt' in fname.lower():
+        return None
+    kind = fileindex.match_first(fileindex.kind_patterns, fname)
+    return kind if kind in watched_kinds else None
+
+
+class EventHandler(FileSystemEventHandler):
+    """
+    Puts the (instrument, fname) of created, modified or moved files
+    on a queue, as watchdog calls it from its own thread.
+    """
+
+    def __init__(self, instrument, queue):
+        self.instrument = instrument
+        self.queue = queue
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        fname = getattr(event, 'dest_path', None) or event.src_path
+        if get_watched_kind(fname):
+            self.queue.put((self.instrument, fname))
+
+
+class Poller(object):
+    """
+    Puts the files that appeared since the last scan of an instrument's
+    directory on the queue.
+    """
+
+    def __init__(self, instrument, data_dir, queue):
+        self.instrument = instrument
+        self.index = fileindex.FileIndex(data_dir)
+        self.queue = queue
+        self.fnames = set(self.index.scan().find())
+
+    def poll(self):
+        fnames = set(self.index.scan().find())
+        for fname in sorted(fnames - self.fnames):
+            if get_watched_kind(fname):
+                self.queue.put((self.instrument, fname))
+        self.fnames = fnames
+
+
+def run_script(script, args):
+    logger.info("Running %s %s" % (script, ' '.join(args)))
+    code = subprocess.call([sys.executable, script] + args, cwd=root_dir)
+    if code != 0:
+        logger.error("%s %s exited with %d" % (script, args[0], code))
+
+
+def process(instrument, fnames):
+    """
+    Pushes settled files through the search (RAW files only), and the
+    parsing, charting and outlier checks of update_website.py.
+    """
+    for fname in fnames:
+        logger.info("New file on %s: %s" % (instrument, fname))
+    raw_fnames = [f for f in fnames if get_watched_kind(f) == 'raw']
+    if raw_fnames:
+        run_script('process_raw_files.py', [instrument, '-new'] + raw_fnames)
+    run_script('update_website.py', [instrument])
+
+
+def watch(instruments, is_polling=False):
+    queue = Queue.Queue()
+    settling = datafile.SettlingFiles(settle_time)
+    instrument_by_fname = {}
+
+    if Observer is None and not is_polling:
+        logger.info("watchdog is not installed, polling instead")
+        is_polling = True
+
+    observer = None
+    pollers = []
+    for instrument in instruments:
+        data_dir = os.path.normpath(
+            os.path.join(root_dir, '..', instrument, 'instrument_data'))
+        if not os.path.isdir(data_dir):
+            logger.warning("No directory " + data_dir)
+            continue
+        logger.info("Watching " + data_dir)
+        if is_polling:
+            pollers.append(Poller(instrument, data_dir, queue))
+        else:
+            if observer is None:
+                observer = Observer()
+            observer.schedule(EventHandler(instrument, queue), data_dir)
+    if observer is not None:
+        observer.start()
+
+    try:
+        while True:
+            time.sleep(poll_interval)
+            for poller in pollers:
+                poller.poll()
+            while not queue.empty():
+                instrument, fname = queue.get()
+                instrument_by_fname[fname] = instrument
+                settling.add(fname)
+
+            settled_by_instrument = {}
+            for fname in settling.pop_settled():
+                instrument = instrument_by_fname.pop(fname)
+                settled_by_instrument.setdefault(instrument, []).append(fname)
+            for instrument in sorted(settled_by_instrument):
+                process(instrument, settled_by_instrument[instrument])
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s|%(name)s|%(levelname)s|%(message)s',
+        datefmt='%Y-%m-%d|%H:%M:%S')
+
+    args = sys.argv[1:]
+    is_polling = '-poll' in args
+    instruments = [a for a in args if not a.startswith('-')]
+    if not instruments:
+        instruments = open(
+            os.path.join(root_dir, 'instruments.txt'), 'Ur').read().split()
+
+    watch(instruments, is_polling)